@@ -1,41 +1,106 @@
+import time
+
+# Отметка начала импорта - от нее считается время запуска воркера
+_IMPORT_STARTED = time.perf_counter()
+
 import os
-import telebot
-from flask import Flask, request, jsonify
+import sys
+import atexit
+import logging
+import logging.handlers
+import random
+import signal
+from flask import Flask, Blueprint, request, jsonify
 import json
 import requests
-import time
 import base64
 import ssl
 from pathlib import Path
 import uuid
+import queue
+import threading
+import tempfile
+import re
+import hashlib
+import html
+import sqlite3
+import bisect
+import heapq
+import math
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка недоступна
+    fcntl = None
+
 # Конфигурация
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
+# id бота - часть токена до ':'; по нему разделяются файлы состояния разных ботов на одной машине
+BOT_ID = (BOT_TOKEN or "").split(":", 1)[0] or "bot"
 GIGACHAT_AUTH = os.environ.get('GIGACHAT_AUTH')
-APP_URL = "https://telegram-bot-x6zm.onrender.com"
+APP_URL = os.environ.get('APP_URL', "https://telegram-bot-x6zm.onrender.com")
 
 # Настройки сертификатов
 CERT_PATH = os.getenv("CERT_PATH", "./cert.pem")
 CERT_URL = os.getenv("CERT_URL")
 
-bot = telebot.TeleBot(BOT_TOKEN)
-app = Flask(__name__)
+# Маршруты регистрируются в приложении через create_app()
+bp = Blueprint('bot', __name__)
 
-print("🚀 Бот запускается...")
-print(f"🔑 Токен: {'✅' if BOT_TOKEN else '❌'}")
-print(f"🧠 GigaChat Auth: {'✅' if GIGACHAT_AUTH else '❌'}")
-print(f"📜 CERT_PATH: {CERT_PATH}")
-print(f"🔗 CERT_URL: {'✅' if CERT_URL else '❌'}")
+def private_temp_path(name):
+    """Путь в личном каталоге пользователя внутри общей временной папки (каталог создается при записи)"""
+    owner = os.getuid() if hasattr(os, "getuid") else os.getenv("USERNAME", "user")
+    return os.path.join(tempfile.gettempdir(), f"telegram_bot-{owner}", name)
 
-# Устанавливаем веб-хук
-try:
-    bot.remove_webhook()
-    time.sleep(1)
-    bot.set_webhook(url=f"{APP_URL}/webhook")
-    print(f"✅ Веб-хук установлен: {APP_URL}/webhook")
-except Exception as e:
-    print(f"❌ Ошибка веб-хука: {e}")
+def ensure_private_dir(directory):
+    """Создает каталог с правами 0700; OSError, если он чужой или доступен на запись другим"""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if hasattr(os, "getuid") and (info.st_uid != os.getuid() or info.st_mode & 0o022):
+        raise OSError(f"каталог {directory} чужой или доступен на запись другим")
+
+def read_private_json(path):
+    """JSON из файла владельца процесса; None - файла нет, это ссылка, он чужой или испорчен"""
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+    except OSError:
+        return None
+    try:
+        if hasattr(os, "getuid") and os.fstat(fd).st_uid != os.getuid():
+            log.warning("Файл %s принадлежит другому пользователю, пропускаем", path)
+            return None
+        with os.fdopen(fd, "r") as f:
+            fd = None
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+def write_private_json(path, data, durable=False):
+    """Атомарная запись через mkstemp (случайное имя, O_EXCL, 0600) и rename; durable - с fsync"""
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
 class Config:
     MAX_RETRIES = 3
@@ -44,6 +109,576 @@ class Config:
     CERT_URL = CERT_URL
     GIGACHAT_AUTH = GIGACHAT_AUTH
 
+    # Адреса вышестоящих сервисов (переопределяются для стендов и нагрузочного теста)
+    TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+    GIGACHAT_API_URL = os.getenv("GIGACHAT_API_URL", "https://gigachat.devices.sberbank.ru/api/v1").rstrip("/")
+    GIGACHAT_OAUTH_URL = os.getenv("GIGACHAT_OAUTH_URL", "https://ngw.devices.sberbank.ru:9443/api/v2/oauth")
+
+    # Фоновая обработка обновлений: pool - очередь и пул потоков, inline - прямо в обработчике.
+    # В режиме pool Telegram получает 200 до обработки и доставку не повторит: при штатной
+    # остановке воркер дообрабатывает принятое (SHUTDOWN_DRAIN_TIMEOUT), а при жестком
+    # завершении (SIGKILL, истекший graceful_timeout gunicorn) очередь и неотправленные ответы теряются
+    DISPATCH_MODE = os.getenv("DISPATCH_MODE", "pool")
+    WORKER_THREADS = int(os.getenv("WORKER_THREADS", "8"))
+    QUEUE_SIZE = int(os.getenv("QUEUE_SIZE", "100"))
+    # Поведение при переполнении очереди: reject - 503 (Telegram повторит доставку позже),
+    # drop - 200 и обновление теряется, wait - ждать QUEUE_PUT_TIMEOUT секунд, затем 503.
+    # Уже принятое в очередь при любой политике теряется при жестком завершении воркера
+    QUEUE_FULL_POLICY = os.getenv("QUEUE_FULL_POLICY", "reject")
+    QUEUE_PUT_TIMEOUT = float(os.getenv("QUEUE_PUT_TIMEOUT", "2"))
+    # Сколько секунд завершающийся воркер дообрабатывает очередь и отправку в Telegram
+    # (меньше graceful_timeout gunicorn, по умолчанию 30 с; 0 - не ждать)
+    SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "25"))
+
+    # Пулы keep-alive соединений: максимум соединений на каждый вышестоящий сервис
+    TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "16"))
+    GIGACHAT_POOL_SIZE = int(os.getenv("GIGACHAT_POOL_SIZE", "16"))
+    OAUTH_POOL_SIZE = int(os.getenv("OAUTH_POOL_SIZE", "2"))
+    # Через сколько секунд простоя пул пересоздается (сервер к этому времени закрывает соединения)
+    HTTP_KEEPALIVE_IDLE = float(os.getenv("HTTP_KEEPALIVE_IDLE", "60"))
+
+    # Общий для воркеров кэш токена GigaChat (пустая строка - хранить только в памяти процесса)
+    # По умолчанию - в каталоге 0700, доступном только владельцу процесса
+    TOKEN_STORE_PATH = os.getenv("TOKEN_STORE_PATH", private_temp_path("gigachat_token.json"))
+    # За сколько секунд до истечения токен обновляется в фоне
+    TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+    # Минимальный остаток жизни токена, с которым его еще можно отдавать в запрос
+    TOKEN_MIN_TTL = float(os.getenv("TOKEN_MIN_TTL", "30"))
+
+    # Потоковые ответы: сообщение появляется с первыми токенами и дополняется через editMessageText
+    STREAMING = os.getenv("STREAMING", "0").lower() in ("1", "true", "yes")
+    # Минимальный интервал между правками одного сообщения (в группах Telegram строже - 20 в минуту)
+    STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+    STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", "3"))
+
+    # Параметры модели (входят в ключ кэша ответов)
+    GIGACHAT_MODEL = os.getenv("GIGACHAT_MODEL", "GigaChat")
+    GIGACHAT_TEMPERATURE = float(os.getenv("GIGACHAT_TEMPERATURE", "0.7"))
+    GIGACHAT_MAX_TOKENS = int(os.getenv("GIGACHAT_MAX_TOKENS", "2000"))
+
+    # Кэш ответов на повторяющиеся вопросы: 0 записей - кэш выключен
+    RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+    RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+    # Файл SQLite для постоянного уровня кэша (пустая строка - только память)
+    RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "")
+    RESPONSE_CACHE_DB_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DB_MAX_ENTRIES", "20000"))
+
+    # База частых вопросов (пустая строка - выключена): пороги балла BM25 и покрытия формулировки из базы
+    FAQ_PATH = os.getenv("FAQ_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "faq.json"))
+    FAQ_MIN_SCORE = float(os.getenv("FAQ_MIN_SCORE", "3"))
+    FAQ_MIN_COVERAGE = float(os.getenv("FAQ_MIN_COVERAGE", "0.75"))
+    # Как часто проверять, не изменился ли файл базы (секунды)
+    FAQ_RELOAD_INTERVAL = float(os.getenv("FAQ_RELOAD_INTERVAL", "10"))
+
+    # Память диалога: реплик на чат (0 - выключена), бюджет токенов истории в запросе.
+    # История хранится в памяти процесса: при нескольких воркерах gunicorn уточнение
+    # видит контекст, только если попало в тот же воркер (см. ConversationMemory)
+    MEMORY_TURNS = int(os.getenv("MEMORY_TURNS", "6"))
+    MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "1500"))
+    # Общие пределы памяти: чаты, символы на все чаты, секунды простоя до забывания чата
+    MEMORY_MAX_CHATS = int(os.getenv("MEMORY_MAX_CHATS", "10000"))
+    MEMORY_MAX_CHARS = int(os.getenv("MEMORY_MAX_CHARS", "5000000"))
+    MEMORY_TTL = float(os.getenv("MEMORY_TTL", "3600"))
+    # Ответ в истории хранится сокращенным до стольких символов
+    MEMORY_ANSWER_CHARS = int(os.getenv("MEMORY_ANSWER_CHARS", "1500"))
+    # Сворачивать не вошедшие в бюджет вопросы в строку-сводку
+    MEMORY_SUMMARY = os.getenv("MEMORY_SUMMARY", "1").lower() in ("1", "true", "yes")
+
+    # Лимиты Telegram на отправку: всего в секунду, в личный чат в секунду, в группу в минуту
+    TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+    TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+    TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+    # Сколько сообщений подряд можно отправить в чат без паузы
+    TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+    TELEGRAM_SENDER_THREADS = int(os.getenv("TELEGRAM_SENDER_THREADS", "4"))
+    TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "5"))
+
+    # Защита от повторной доставки: сколько update_id и сколько секунд помнить
+    DEDUP_CAPACITY = int(os.getenv("DEDUP_CAPACITY", "100000"))
+    DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", "86400"))
+    # Общий для воркеров файл SQLite с увиденными update_id (пустая строка - только память процесса)
+    DEDUP_DB = os.getenv("DEDUP_DB", private_temp_path(f"updates-{BOT_ID}.db"))
+
+    # Допуск к GigaChat: одновременных запросов, ожидающих на пользователя и всего, секунд ожидания
+    GIGACHAT_MAX_CONCURRENCY = int(os.getenv("GIGACHAT_MAX_CONCURRENCY", "4"))
+    # Каталог файлов-слотов, через который лимит соблюдается всеми воркерами вместе
+    # (пустая строка - лимит на каждый процесс отдельно)
+    GIGACHAT_SLOTS_DIR = os.getenv("GIGACHAT_SLOTS_DIR", private_temp_path("gigachat_slots"))
+    GIGACHAT_USER_QUEUE = int(os.getenv("GIGACHAT_USER_QUEUE", "2"))
+    GIGACHAT_MAX_QUEUED = int(os.getenv("GIGACHAT_MAX_QUEUED", "50"))
+    GIGACHAT_MAX_WAIT = float(os.getenv("GIGACHAT_MAX_WAIT", "30"))
+
+    # Склейка сообщений чата, пришедших с паузой меньше окна, в один вопрос (0 - выключено)
+    COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", "0"))
+
+    # Общий бюджет времени на вопрос пользователя: ожидание слота, попытки и паузы между ними
+    GIGACHAT_DEADLINE = float(os.getenv("GIGACHAT_DEADLINE", "45"))
+    GIGACHAT_ATTEMPTS = int(os.getenv("GIGACHAT_ATTEMPTS", "2"))
+    # Таймаут попытки: перцентиль наблюдаемой задержки x множитель в пределах [MIN, MAX]
+    GIGACHAT_TIMEOUT_MIN = float(os.getenv("GIGACHAT_TIMEOUT_MIN", "5"))
+    GIGACHAT_TIMEOUT_MAX = float(os.getenv("GIGACHAT_TIMEOUT_MAX", str(REQUEST_TIMEOUT)))
+    GIGACHAT_TIMEOUT_PERCENTILE = float(os.getenv("GIGACHAT_TIMEOUT_PERCENTILE", "0.99"))
+    GIGACHAT_TIMEOUT_MULTIPLIER = float(os.getenv("GIGACHAT_TIMEOUT_MULTIPLIER", "2"))
+    # Автомат отключения: окно в секундах, минимум вызовов, пороги долей ошибок и медленных вызовов
+    GIGACHAT_BREAKER_WINDOW = float(os.getenv("GIGACHAT_BREAKER_WINDOW", "60"))
+    GIGACHAT_BREAKER_MIN_CALLS = int(os.getenv("GIGACHAT_BREAKER_MIN_CALLS", "10"))
+    GIGACHAT_BREAKER_ERROR_RATE = float(os.getenv("GIGACHAT_BREAKER_ERROR_RATE", "0.5"))
+    GIGACHAT_BREAKER_SLOW_CALL = float(os.getenv("GIGACHAT_BREAKER_SLOW_CALL", "20"))
+    GIGACHAT_BREAKER_SLOW_RATE = float(os.getenv("GIGACHAT_BREAKER_SLOW_RATE", "0.8"))
+    # Сколько секунд цепь разомкнута и сколько пробных запросов пропускается после этого
+    GIGACHAT_BREAKER_OPEN_SECONDS = float(os.getenv("GIGACHAT_BREAKER_OPEN_SECONDS", "30"))
+    GIGACHAT_BREAKER_PROBES = int(os.getenv("GIGACHAT_BREAKER_PROBES", "1"))
+
+    # Каталог снимков метрик для агрегации между воркерами (пустая строка - только свой процесс)
+    METRICS_DIR = os.getenv("METRICS_DIR", private_temp_path("metrics"))
+    METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+    # Режим long polling (python app.py poll): размер пачки, ожидание на стороне Telegram, файл смещения
+    POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))
+    POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+    POLL_OFFSET_PATH = os.getenv("POLL_OFFSET_PATH", private_temp_path(f"poll-offset-{BOT_ID}.json"))
+    POLL_ALLOWED_UPDATES = [kind for kind in os.getenv("POLL_ALLOWED_UPDATES", "message").split(",") if kind]
+
+    # Имя бота без @ для команд вида /help@имя_бота (по умолчанию берется из getMe)
+    BOT_USERNAME = os.getenv("BOT_USERNAME", "").lstrip("@")
+
+    # Фоновая проверка доступности сервисов: период и таймаут (секунды), сколько результатов хранить
+    HEALTH_INTERVAL = float(os.getenv("HEALTH_INTERVAL", "60"))
+    HEALTH_TIMEOUT = float(os.getenv("HEALTH_TIMEOUT", "5"))
+    HEALTH_HISTORY = int(os.getenv("HEALTH_HISTORY", "20"))
+
+    # Логирование: уровень, формат json или text, доля сохраняемых строк о каждом сообщении
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+    LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# ЛОГИРОВАНИЕ: СТРУКТУРИРОВАННЫЕ ЗАПИСИ, ЗАПИСЬ В ФОНОВОМ ПОТОКЕ
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, сообщение и служебные поля из extra"""
+
+    FIELDS = ('chat_id', 'user_id', 'update_id', 'method', 'status', 'result', 'chars', 'latency_ms')
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage()
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю rate записей, помеченных extra={'sampled': True}"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1 or not getattr(record, 'sampled', False):
+            return True
+        return random.random() < self.rate
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в ограниченную очередь; форматирование и запись - в потоке QueueListener
+
+    Стандартный QueueHandler форматирует запись в вызывающем потоке, здесь это
+    отложено до фонового потока. При переполнении очереди запись отбрасывается.
+    """
+
+    def __init__(self, target, maxsize):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.target = target
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def ensure_listener(self):
+        if self._pid != os.getpid():
+            self._start_listener()
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_listener(self):
+        """Поток записи лениво запускается в каждом процессе: после fork его нет
+
+        Очередь тоже создается заново: блокировка унаследованной очереди могла
+        быть захвачена потоком записи родителя в момент fork.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.maxsize)
+            self._listener = logging.handlers.QueueListener(self.queue, self.target,
+                                                            respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self._stop_listener, self._listener, self._pid)
+
+    @staticmethod
+    def _stop_listener(listener, pid):
+        """atexit наследуется при fork: останавливаем только поток своего процесса"""
+        if pid == os.getpid():
+            listener.stop()
+
+    def stats(self):
+        return {
+            "level": Config.LOG_LEVEL.upper(),
+            "format": Config.LOG_FORMAT,
+            "sample_rate": Config.LOG_SAMPLE_RATE,
+            "queued": self.queue.qsize(),
+            "dropped": self.dropped
+        }
+
+def setup_logging():
+    """Настраивает логгер бота: уровень, формат (json или text), выборка и фоновая запись"""
+    logger = logging.getLogger('bot')
+    if logger.handlers:
+        return logger, logger.handlers[0]
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if Config.LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s] %(message)s'))
+    handler = BackgroundQueueHandler(stream_handler, Config.LOG_QUEUE_SIZE)
+    logger.addHandler(handler)
+    logger.addFilter(SamplingFilter(Config.LOG_SAMPLE_RATE))
+    logger.setLevel(Config.LOG_LEVEL.upper())
+    logger.propagate = False
+    return logger, handler
+
+log, log_handler = setup_logging()
+
+# МЕТРИКИ В ФОРМАТЕ PROMETHEUS
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class _Metric:
+    """Базовая метрика: значения по кортежам меток под собственной короткой блокировкой"""
+
+    kind = None
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, registry, name, help_text, labelnames=(), merge='sum'):
+        # Как сводить значения воркеров: sum - количества, max - состояния вида 0/1
+        self.merge = merge
+        super().__init__(registry, name, help_text, labelnames)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(registry, name, help_text, labelnames)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Счетчики по корзинам (последняя - +Inf), сумма, количество
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), [list(state[0]), state[1], state[2]]] for labels, state in self._values.items()]
+
+class CallbackMetric:
+    """Метрика, значение которой читается из состояния приложения в момент сбора"""
+
+    def __init__(self, registry, kind, name, help_text, func, labelnames=(), merge='sum'):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self.merge = merge
+        registry.register(self)
+
+    def snapshot(self):
+        value = self.func()
+        if isinstance(value, dict):
+            return [[list(labels if isinstance(labels, tuple) else (labels,)), v] for labels, v in value.items()]
+        return [[[], value]]
+
+class MetricsRegistry:
+    """Реестр метрик с агрегацией между воркерами gunicorn
+
+    Каждый процесс периодически сбрасывает свой снимок в metrics-<pid>.json в общем
+    каталоге; /metrics сводит снимки воркеров того же родителя (мастера gunicorn):
+    счетчики и гистограммы складываются, gauge - суммой или максимумом (merge).
+    Снимки умерших воркеров добавляются в aggregate-<ppid>.json и удаляются, так что
+    их счетчики не теряются, а число файлов не растет. Файлы прошлых запусков с
+    завершившимся родителем удаляются.
+    """
+
+    def __init__(self, directory, flush_interval):
+        self.directory = directory or None
+        self.flush_interval = flush_interval
+        self._metrics = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def ensure_flusher(self):
+        if not self.directory or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            try:
+                ensure_private_dir(self.directory)
+            except OSError as e:
+                log.warning("Каталог метрик недоступен, метрики только своего процесса: %s", e)
+                self.directory = None
+                return
+            threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def snapshot(self):
+        metrics = {}
+        for metric in self._metrics:
+            try:
+                samples = metric.snapshot()
+            except Exception as e:
+                log.warning("Метрика %s недоступна: %s", metric.name, e)
+                continue
+            metrics[metric.name] = {
+                "type": metric.kind,
+                "help": metric.help,
+                "labelnames": list(metric.labelnames),
+                "buckets": list(getattr(metric, 'buckets', ())),
+                "merge": getattr(metric, 'merge', 'sum'),
+                "samples": samples
+            }
+        return {"pid": os.getpid(), "ppid": os.getppid(), "metrics": metrics}
+
+    def flush(self):
+        if not self.directory:
+            return
+        self._write(os.path.join(self.directory, f"metrics-{os.getpid()}.json"), self.snapshot())
+
+    @staticmethod
+    def _write(path, snapshot):
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            log.warning("Не удалось сохранить метрики: %s", e)
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _collect_snapshots(self):
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        ppid = os.getppid()
+        aggregate_path = os.path.join(self.directory, f"aggregate-{ppid}.json")
+        snapshots = []
+        dead = []
+        # Под блокировкой: два одновременных сбора не сложат умерший воркер дважды
+        with _FileLock(os.path.join(self.directory, "fold.lock")):
+            for file_name in os.listdir(self.directory):
+                path = os.path.join(self.directory, file_name)
+                if not file_name.endswith(".json"):
+                    continue
+                if file_name.startswith("aggregate-"):
+                    owner = file_name[len("aggregate-"):-len(".json")]
+                    if owner.isdigit() and int(owner) != ppid and not self._pid_alive(int(owner)):
+                        self._remove(path)
+                    continue
+                if not file_name.startswith("metrics-"):
+                    continue
+                snapshot = self._load(path)
+                if snapshot is None:
+                    continue
+                pid = snapshot.get("pid") or 0
+                alive = pid == os.getpid() or self._pid_alive(pid)
+                if snapshot.get("ppid") != ppid:
+                    # Живой процесс другого экземпляра не наш; умерший - остаток прошлого запуска
+                    if not alive:
+                        self._remove(path)
+                    continue
+                if alive:
+                    snapshots.append(snapshot)
+                else:
+                    dead.append((path, snapshot))
+            aggregate = self._load(aggregate_path)
+            if dead:
+                merged = {}
+                for snapshot in ([aggregate] if aggregate else []) + [snapshot for _, snapshot in dead]:
+                    self._merge(merged, snapshot, gauges=False)
+                aggregate = {"pid": None, "ppid": ppid, "metrics": {
+                    name: dict(metric, samples=[[list(key), value] for key, value in metric["samples"].items()])
+                    for name, metric in merged.items()
+                }}
+                self._write(aggregate_path, aggregate)
+                for path, _ in dead:
+                    self._remove(path)
+        if aggregate:
+            snapshots.append(aggregate)
+        return snapshots
+
+    @staticmethod
+    def _pid_alive(pid):
+        if pid <= 0:
+            return False
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+    @staticmethod
+    def _merge(merged, snapshot, gauges=True):
+        """Добавляет снимок к сводке {имя: метрика с samples по кортежам меток}"""
+        for name, metric in snapshot.get("metrics", {}).items():
+            if metric["type"] == "gauge" and not gauges:
+                continue
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for labels, value in metric["samples"]:
+                key = tuple(labels)
+                current = target["samples"].get(key)
+                if metric["type"] == "histogram":
+                    if current is None:
+                        target["samples"][key] = [list(value[0]), value[1], value[2]]
+                    else:
+                        current[0] = [a + b for a, b in zip(current[0], value[0])]
+                        current[1] += value[1]
+                        current[2] += value[2]
+                elif current is None:
+                    target["samples"][key] = value
+                elif metric.get("merge") == "max":
+                    target["samples"][key] = max(current, value)
+                else:
+                    target["samples"][key] = current + value
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus 0.0.4"""
+        merged = {}
+        for snapshot in self._collect_snapshots():
+            self._merge(merged, snapshot)
+
+        lines = []
+        for name in sorted(merged):
+            metric = merged[name]
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            labelnames = metric["labelnames"]
+            for labels, value in sorted(metric["samples"].items()):
+                pairs = [f'{k}="{_escape_label(v)}"' for k, v in zip(labelnames, labels)]
+                if metric["type"] == "histogram":
+                    cumulative = 0
+                    bounds = [str(b) for b in metric["buckets"]] + ["+Inf"]
+                    for bound, count in zip(bounds, value[0]):
+                        cumulative += count
+                        bucket_pairs = pairs + ['le="%s"' % bound]
+                        lines.append(f"{name}_bucket{{{','.join(bucket_pairs)}}} {cumulative}")
+                    label_text = f"{{{','.join(pairs)}}}" if pairs else ""
+                    lines.append(f"{name}_sum{label_text} {value[1]}")
+                    lines.append(f"{name}_count{label_text} {value[2]}")
+                else:
+                    label_text = f"{{{','.join(pairs)}}}" if pairs else ""
+                    lines.append(f"{name}{label_text} {value}")
+        return "\n".join(lines) + "\n"
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+metrics = MetricsRegistry(Config.METRICS_DIR, Config.METRICS_FLUSH_INTERVAL)
+
+WEBHOOK_DURATION = Histogram(metrics, "bot_webhook_duration_seconds",
+                             "Время обработки запроса /webhook", ("result",))
+GIGACHAT_REQUEST_DURATION = Histogram(metrics, "bot_gigachat_request_duration_seconds",
+                                      "Задержка запроса chat/completions по коду ответа", ("status",))
+GIGACHAT_ADMISSION_WAIT = Histogram(metrics, "bot_gigachat_admission_wait_seconds",
+                                    "Ожидание слота GigaChat")
+TOKEN_REFRESHES = Counter(metrics, "bot_gigachat_token_refresh_total",
+                          "Обновления токена GigaChat", ("result",))
+TOKEN_REFRESH_DURATION = Histogram(metrics, "bot_gigachat_token_refresh_duration_seconds",
+                                   "Длительность получения токена GigaChat")
+TELEGRAM_SEND_DURATION = Histogram(metrics, "bot_telegram_send_duration_seconds",
+                                   "Задержка вызова Bot API по методу и коду ответа", ("method", "status"))
+TELEGRAM_THROTTLED = Counter(metrics, "bot_telegram_429_total",
+                             "Ответы 429 Too Many Requests от Bot API", ("method",))
+
 def download_certificate():
     """Загрузка SSL-сертификата при необходимости"""
     if Config.CERT_URL and not Path(Config.CERT_PATH).exists():
@@ -52,16 +687,129 @@ def download_certificate():
             response.raise_for_status()
             with open(Config.CERT_PATH, "wb") as f:
                 f.write(response.content)
-            print("✅ Сертификат успешно загружен")
+            reset_ssl_verify()
+            log.info("Сертификат успешно загружен")
         except Exception as e:
-            print(f"❌ Ошибка загрузки сертификата: {e}")
+            log.error("Ошибка загрузки сертификата: %s", e)
+            raise
+
+# SSL-ПРОВЕРКА ДЛЯ GIGACHAT (вычисляется один раз)
+_ssl_verify = None
+
+def gigachat_ssl_verify():
+    """Путь к CA-бандлу GigaChat или False, если сертификата нет"""
+    global _ssl_verify
+    if _ssl_verify is None:
+        _ssl_verify = Config.CERT_PATH if Path(Config.CERT_PATH).exists() else False
+        log.info("Используем SSL проверку: %s", _ssl_verify)
+    return _ssl_verify
+
+def reset_ssl_verify():
+    """Сбрасывает кэш после загрузки сертификата"""
+    global _ssl_verify
+    _ssl_verify = None
+
+# ПУЛЫ KEEP-ALIVE СОЕДИНЕНИЙ
+class UpstreamSession:
+    """Долгоживущая сессия с пулом соединений к одному вышестоящему сервису"""
+
+    def __init__(self, name, pool_size, verify=None):
+        self.name = name
+        self.pool_size = max(1, pool_size)
+        # verify: None - проверка по умолчанию, иначе функция, возвращающая значение verify
+        self.verify = verify
+        self._session = None
+        self._pid = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.resets = 0
+
+    def _get_session(self):
+        now = time.monotonic()
+        session = self._session
+        if session is None or self._pid != os.getpid() or now - self._last_used > Config.HTTP_KEEPALIVE_IDLE:
+            with self._lock:
+                session = self._session
+                idle = now - self._last_used > Config.HTTP_KEEPALIVE_IDLE
+                if session is None or self._pid != os.getpid() or idle:
+                    # Соединения родителя после fork и давно простаивающие не используем
+                    if session is not None and self._pid == os.getpid():
+                        session.close()
+                        self.resets += 1
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+                self._last_used = now
+        else:
+            self._last_used = now
+        return session
+
+    def request(self, method, url, **kwargs):
+        if self.verify is not None:
+            kwargs.setdefault('verify', self.verify())
+        kwargs.setdefault('timeout', Config.REQUEST_TIMEOUT)
+        self.requests += 1
+        try:
+            return self._get_session().request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.errors += 1
             raise
 
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def stats(self):
+        connections = 0
+        idle = 0
+        pooled_requests = 0
+        session = self._session
+        if session is not None and self._pid == os.getpid():
+            adapter = session.get_adapter('https://')
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+                if pool.pool is not None:
+                    # Очередь пула заполнена заглушками None - считаем только живые соединения
+                    idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        return {
+            "pool_size": self.pool_size,
+            "keepalive_idle": Config.HTTP_KEEPALIVE_IDLE,
+            "requests": self.requests,
+            "errors": self.errors,
+            "connections_opened": connections,
+            "connections_idle": idle,
+            "pool_requests": pooled_requests,
+            "resets": self.resets
+        }
+
+telegram_http = UpstreamSession("telegram", Config.TELEGRAM_POOL_SIZE)
+gigachat_http = UpstreamSession("gigachat", Config.GIGACHAT_POOL_SIZE, verify=gigachat_ssl_verify)
+oauth_http = UpstreamSession("oauth", Config.OAUTH_POOL_SIZE, verify=gigachat_ssl_verify)
+
+def telegram_url(method):
+    """URL метода Bot API с учетом TELEGRAM_API_URL"""
+    return f"{Config.TELEGRAM_API_URL}/bot{BOT_TOKEN}/{method}"
+
+def http_pool_stats():
+    return {pool.name: pool.stats() for pool in (telegram_http, gigachat_http, oauth_http)}
+
 @retry(stop=stop_after_attempt(Config.MAX_RETRIES), 
       wait=wait_exponential(multiplier=1, min=2, max=10))
-def get_gigachat_token() -> str:
-    """Получение токена доступа GigaChat"""
-    url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
+def get_gigachat_token() -> dict:
+    """Получение токена доступа GigaChat: access_token и expires_at"""
+    url = Config.GIGACHAT_OAUTH_URL
     headers = {
         'Content-Type': 'application/x-www-form-urlencoded',
         'Accept': 'application/json',
@@ -71,271 +819,2345 @@ def get_gigachat_token() -> str:
     payload = {'scope': 'GIGACHAT_API_PERS'}
     
     try:
-        verify_ssl = Config.CERT_PATH if Path(Config.CERT_PATH).exists() else False
-        print(f"🔐 Используем SSL проверку: {verify_ssl}")
-        
-        response = requests.post(
+        response = oauth_http.post(
             url, 
             headers=headers, 
-            data=payload, 
-            verify=verify_ssl,
-            timeout=Config.REQUEST_TIMEOUT
+            data=payload
         )
         
-        print(f"🔐 Статус аутентификации: {response.status_code}")
+        log.info("Статус аутентификации: %s", response.status_code, extra={"status": response.status_code})
         
         if response.status_code == 200:
             token_data = response.json()
             access_token = token_data.get("access_token")
             if access_token:
-                print("✅ Токен GigaChat получен успешно")
-                return access_token
+                log.info("Токен GigaChat получен успешно")
+                return token_data
             else:
-                print("❌ Токен не найден в ответе")
+                log.error("Токен не найден в ответе")
         else:
-            print(f"❌ Ошибка аутентификации: {response.status_code} - {response.text}")
+            log.error("Ошибка аутентификации: %s - %s", response.status_code, response.text,
+                      extra={"status": response.status_code})
             
         raise Exception(f"Ошибка получения токена: {response.status_code}")
         
     except requests.exceptions.RequestException as e:
-        print(f"❌ Ошибка получения токена: {e}")
+        log.error("Ошибка получения токена: %s", e)
         raise
 
+# МЕНЕДЖЕР ТОКЕНА GIGACHAT
+class GigaChatTokenManager:
+    """Токен GigaChat, общий для воркеров, с упреждающим обновлением в фоне"""
+
+    def __init__(self, store_path, refresh_margin, min_ttl):
+        self.store_path = store_path
+        self.refresh_margin = refresh_margin
+        self.min_ttl = min_ttl
+        self._token = None
+        self._expires_at = 0.0
+        # Одно обновление за раз внутри процесса; между процессами - flock на файле
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.store_reads = 0
+        self.last_error = None
+        self._store_checked = False
+
+    @staticmethod
+    def _parse_expires_at(token_data):
+        """OAuth возвращает expires_at в миллисекундах; без него считаем 25 минут"""
+        expires_at = token_data.get("expires_at")
+        if not expires_at:
+            return time.time() + 1500
+        expires_at = float(expires_at)
+        return expires_at / 1000 if expires_at > 1e11 else expires_at
+
+    def _is_fresh(self, expires_at, min_ttl):
+        return expires_at - time.time() > min_ttl
+
+    def get_token(self):
+        """Возвращает действующий токен; OAuth вызывается только если токена нет вовсе"""
+        self._ensure_refresher()
+        token, expires_at = self._token, self._expires_at
+        if token and self._is_fresh(expires_at, self.min_ttl):
+            return token
+        return self._refresh(self.min_ttl)
+
+    def invalidate(self, token):
+        """Сбрасывает токен, отвергнутый GigaChat (ошибка 401)"""
+        with self._lock:
+            if self._token == token:
+                self._token = None
+                self._expires_at = 0.0
+                stored_token, _ = self._read_store()
+                if stored_token == token:
+                    self._remove_store()
+
+    def _refresh(self, min_ttl):
+        """Single-flight обновление: остальные потоки ждут и получают тот же токен"""
+        with self._lock:
+            if self._token and self._is_fresh(self._expires_at, min_ttl):
+                return self._token
+            token, expires_at = self._read_store()
+            if not (token and self._is_fresh(expires_at, min_ttl)):
+                with self._store_lock():
+                    # Пока ждали блокировку, токен мог обновить другой воркер
+                    token, expires_at = self._read_store()
+                    if not (token and self._is_fresh(expires_at, min_ttl)):
+                        log.info("Получаем новый токен GigaChat")
+                        started = time.perf_counter()
+                        try:
+                            token_data = get_gigachat_token()
+                        except Exception as e:
+                            self.refresh_failures += 1
+                            self.last_error = str(e)
+                            TOKEN_REFRESHES.inc("error")
+                            raise
+                        finally:
+                            TOKEN_REFRESH_DURATION.observe(time.perf_counter() - started)
+                        TOKEN_REFRESHES.inc("ok")
+                        token = token_data["access_token"]
+                        expires_at = self._parse_expires_at(token_data)
+                        self.refreshes += 1
+                        self.last_error = None
+                        self._write_store(token, expires_at)
+            self._token, self._expires_at = token, expires_at
+        self._wakeup.set()
+        return token
+
+    def _ensure_refresher(self):
+        """Запускает фоновое обновление (лениво, отдельно в каждом воркере)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._refresh_loop, name="gigachat-token-refresh", daemon=True)
+            thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            if not self._token:
+                # Первый токен появится по запросу - до этого обновлять нечего
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            delay = self._expires_at - self.refresh_margin - time.time()
+            if delay > 0:
+                if self._wakeup.wait(delay):
+                    self._wakeup.clear()
+                    continue
+            try:
+                self._refresh(self.refresh_margin)
+            except Exception as e:
+                log.error("Фоновое обновление токена не удалось: %s", e)
+                # Повторяем чаще, пока текущий токен еще действует
+                self._wakeup.wait(min(30.0, max(1.0, (self._expires_at - time.time()) / 4)))
+                self._wakeup.clear()
+
+    def _store_usable(self):
+        """Каталог хранилища создается с правами 0700 и должен принадлежать нам
+
+        Иначе файл с токеном могли бы подменить или прочитать другие пользователи
+        машины: тогда хранилище отключается и токен живет только в памяти процесса.
+        """
+        if self._store_checked:
+            return bool(self.store_path)
+        self._store_checked = True
+        if not self.store_path:
+            return False
+        try:
+            ensure_private_dir(os.path.dirname(os.path.abspath(self.store_path)))
+        except OSError as e:
+            log.warning("Общее хранилище токена отключено: %s", e)
+            self.store_path = None
+            return False
+        return True
+
+    def _read_store(self):
+        if not self._store_usable():
+            return None, 0.0
+        data = read_private_json(self.store_path)
+        try:
+            token, expires_at = data.get("access_token"), float(data.get("expires_at", 0))
+        except (AttributeError, TypeError, ValueError):
+            return None, 0.0
+        self.store_reads += 1
+        return token, expires_at
+
+    def _write_store(self, token, expires_at):
+        if not self._store_usable():
+            return
+        try:
+            write_private_json(self.store_path, {"access_token": token, "expires_at": expires_at})
+        except OSError as e:
+            log.warning("Не удалось сохранить токен в %s: %s", self.store_path, e)
+
+    def _remove_store(self):
+        if not self.store_path:
+            return
+        try:
+            os.remove(self.store_path)
+        except OSError:
+            pass
+
+    def _store_lock(self):
+        return _FileLock(f"{self.store_path}.lock" if self._store_usable() else None)
+
+    def stats(self):
+        return {
+            "has_token": bool(self._token),
+            "expires_in": round(self._expires_at - time.time(), 1) if self._token else None,
+            "refresh_margin": self.refresh_margin,
+            "shared_store": self.store_path or None,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "last_error": self.last_error
+        }
+
+class _FileLock:
+    """Эксклюзивная межпроцессная блокировка через flock (без fcntl - ничего не делает)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        if self.path and fcntl is not None:
+            try:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except OSError as e:
+                log.warning("Блокировка %s недоступна: %s", self.path, e)
+                self._close()
+        return self
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._close()
+        return False
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+token_manager = GigaChatTokenManager(Config.TOKEN_STORE_PATH, Config.TOKEN_REFRESH_MARGIN, Config.TOKEN_MIN_TTL)
+
+# Промпт для специализации на международных отношениях
+SYSTEM_PROMPT = """Ты - эксперт в области международных отношений. Твоя специализация включает:
+
+🎓 **Образование и поступление:**
+- Вузы для международных отношений (МГИМО, МГУ, СПбГУ, ВШЭ, РУДН)
+- Вступительные экзамены и требования
+- Программы обучения и специализации
+
+📚 **Основные понятия:**
+- Дипломатия и внешняя политика
+- Международное право
+- Геополитика и международная безопасность
+- Глобализация и международные экономические отношения
+
+💼 **Карьера:**
+- Дипломатическая служба
+- Международные организации (ООН, НАТО, ЕС, ВТО, МВФ)
+- Международный бизнес
+- Аналитические центры и СМИ
+
+🌍 **Практические аспекты:**
+- Современные международные конфликты
+- Международные договоры и соглашения
+- Внешняя политика России и других стран
+
+Отвечай подробно, информативно, с конкретными примерами и практическими советами. Структурируй ответы для лучшего восприятия."""
+
+NOT_CONFIGURED_MESSAGE = "❌ GigaChat не настроен. Добавьте GIGACHAT_AUTH в настройках Render."
+
+AUTH_ERROR_MESSAGE = """
+❌ Не удалось авторизоваться в GigaChat. 
+
+Возможные причины:
+1. Неверный GIGACHAT_AUTH в настройках Render
+2. Ключ не активирован в личном кабинете SberBank AI
+3. Проблемы с сертификатами
+
+💡 Для получения GIGACHAT_AUTH:
+1. Перейдите на https://developers.sber.ru/studio/auth
+2. Авторизуйтесь через СберID
+3. Создайте новое приложение
+4. Получите Client ID и Client Secret
+5. Используйте их в формате base64(ClientID:ClientSecret)
+"""
+
+CONNECTION_ERROR_MESSAGE = "❌ Ошибка соединения с GigaChat. Попробуйте позже."
+
+BUSY_MESSAGE = "⏳ Сейчас много вопросов. Пожалуйста, повторите свой чуть позже."
+
+UNAVAILABLE_MESSAGE = "⏳ GigaChat временно недоступен. Пожалуйста, повторите вопрос через минуту."
+
+# КЭШ ОТВЕТОВ НА ПОВТОРЯЮЩИЕСЯ ВОПРОСЫ
+class ResponseCache:
+    """LRU-кэш ответов GigaChat с TTL и необязательным постоянным уровнем в SQLite"""
+
+    _PUNCTUATION = re.compile(r'[^\w\s]+')
+    _SPACES = re.compile(r'\s+')
+
+    def __init__(self, max_entries, ttl, db_path=None, db_max_entries=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path or None
+        self.db_max_entries = db_max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._puts = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @classmethod
+    def normalize(cls, text):
+        """Регистр, пунктуация, пробелы и ё/е не должны влиять на совпадение вопросов"""
+        text = text.lower().replace('ё', 'е')
+        text = cls._PUNCTUATION.sub(' ', text)
+        return cls._SPACES.sub(' ', text).strip()
+
+    def make_key(self, user_message, system_prompt, params):
+        material = json.dumps([self.normalize(user_message), system_prompt, params],
+                              ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, text = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return text
+                del self._entries[key]
+        text, expires_at = self._db_get(key, now)
+        with self._lock:
+            if text is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, text, expires_at)
+        return text
+
+    def put(self, key, text):
+        if not self.enabled or not text:
+            return
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, text, expires_at)
+        self._db_put(key, text, expires_at)
+
+    def _remember(self, key, text, expires_at):
+        self._entries[key] = (expires_at, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _db(self):
+        """Отдельное соединение на поток и на процесс: sqlite3 не делит их между потоками"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS responses "
+                     "(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _db_get(self, key, now):
+        if not self.db_path:
+            return None, 0.0
+        try:
+            row = self._db().execute(
+                "SELECT response, expires_at FROM responses WHERE key = ? AND expires_at > ?",
+                (key, now)
+            ).fetchone()
+        except sqlite3.Error as e:
+            log.warning("Ошибка чтения кэша ответов: %s", e)
+            return None, 0.0
+        return (row[0], row[1]) if row else (None, 0.0)
+
+    def _db_put(self, key, text, expires_at):
+        if not self.db_path:
+            return
+        try:
+            conn = self._db()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)",
+                             (key, text, expires_at))
+                self._puts += 1
+                if self._puts % 100 == 0:
+                    # Периодически удаляем просроченное и самое старое сверх лимита
+                    conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+                    if self.db_max_entries > 0:
+                        conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                                     "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.db_max_entries,))
+        except sqlite3.Error as e:
+            log.warning("Ошибка записи кэша ответов: %s", e)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "persistent": bool(self.db_path),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else None
+        }
+
+response_cache = ResponseCache(Config.RESPONSE_CACHE_SIZE, Config.RESPONSE_CACHE_TTL,
+                               Config.RESPONSE_CACHE_DB, Config.RESPONSE_CACHE_DB_MAX_ENTRIES)
+
+# БАЗА ЧАСТЫХ ВОПРОСОВ: ОТВЕТЫ БЕЗ GIGACHAT
+class _FaqSnapshot:
+    """Неизменяемый индекс: при перезагрузке строится новый и подменяется целиком"""
+    __slots__ = ('answers', 'entry_terms', 'doc_entries', 'doc_mass', 'postings', 'idf')
+
+class FaqIndex:
+    """Поиск по базе частых вопросов: обратный индекс и ранжирование BM25
+
+    Документ индекса - одна формулировка вопроса; вес каждого термина в документе
+    посчитан заранее, поэтому поиск - это сумма весов по спискам вхождений. Ответ
+    засчитывается, только если балл не ниже min_score, совпавшие термины покрывают
+    не меньше min_coverage (по idf) формулировки из базы, а каждое значимое слово
+    вопроса пользователя встречается в формулировках этого ответа: лишнее слово
+    ("...на журналистику?", "...и как их реформировать?") означает другой вопрос.
+    Файл перечитывается без перезапуска, когда меняется время его изменения.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    _WORD = re.compile(r'\w+')
+    STOP_WORDS = frozenset(
+        "а и в во на но для по к ко с со о об от до из у за что как какой какая какое какие каких "
+        "ли же бы не ни то это там тут мне я мы вы он она они его ее их можно нужно нужен нужна "
+        "нужны есть или при про после чем где кто когда сколько ли уже еще так "
+        "подскажите скажите расскажите расскажи подскажи пожалуйста вообще такое хочу".split()
+    )
+
+    # Указательные слова и союзы в начале: вопрос опирается на предыдущую реплику
+    FOLLOW_UP_WORDS = frozenset(
+        "там тут здесь туда оттуда это этот эта эти этого этой этих этом тот та те того той тех "
+        "он она оно они его ее их им ими него нее них ним ней нем тоже также тогда такой такая такие".split()
+    )
+    FOLLOW_UP_OPENERS = frozenset("а и но".split())
+
+    def __init__(self, path, min_score, min_coverage, reload_interval):
+        self.path = path or None
+        self.min_score = min_score
+        self.min_coverage = min_coverage
+        self.reload_interval = reload_interval
+        self._snapshot = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._reload_lock = threading.Lock()
+        self.loaded_at = None
+        self.reloads = 0
+        self.reload_errors = 0
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_time = 0.0
+
+    @classmethod
+    def tokenize(cls, text):
+        """Нижний регистр, ё -> е, без стоп-слов; от длинных слов остается основа из 5 букв"""
+        words = cls._WORD.findall(text.lower().replace('ё', 'е'))
+        return [word[:5] for word in words if word not in cls.STOP_WORDS]
+
+    @classmethod
+    def is_follow_up(cls, text):
+        """Похож ли вопрос на уточнение ("а какие там проходные баллы?"): без истории он неполон"""
+        words = cls._WORD.findall(text.lower().replace('ё', 'е'))
+        return bool(words) and (words[0] in cls.FOLLOW_UP_OPENERS or
+                                any(word in cls.FOLLOW_UP_WORDS for word in words))
+
+    def load(self):
+        """Читает файл и строит индекс; при ошибке остается прежний индекс"""
+        if not self.path:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+            snapshot = self._build(entries)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.reload_errors += 1
+            log.error("Не удалось загрузить базу частых вопросов %s: %s", self.path, e)
+            return False
+        self._snapshot = snapshot
+        self._mtime = mtime
+        self.loaded_at = time.time()
+        self.reloads += 1
+        log.info("База частых вопросов загружена: %s ответов, %s формулировок, %s терминов",
+                 len(snapshot.answers), len(snapshot.doc_entries), len(snapshot.idf))
+        return True
+
+    def _build(self, entries):
+        answers = []
+        entry_terms = []
+        doc_entries = []
+        documents = []
+        for entry in entries:
+            answers.append(entry["answer"])
+            vocabulary = set()
+            for question in entry["questions"]:
+                terms = self.tokenize(question)
+                if terms:
+                    doc_entries.append(len(answers) - 1)
+                    documents.append(terms)
+                    vocabulary.update(terms)
+            entry_terms.append(frozenset(vocabulary))
+        
+        count = len(documents)
+        avg_length = sum(len(terms) for terms in documents) / count if count else 1.0
+        frequency = {}
+        for terms in documents:
+            for term in set(terms):
+                frequency[term] = frequency.get(term, 0) + 1
+        idf = {term: math.log(1 + (count - df + 0.5) / (df + 0.5)) for term, df in frequency.items()}
+        
+        postings = {}
+        doc_mass = []
+        for doc, terms in enumerate(documents):
+            norm = self.K1 * (1 - self.B + self.B * len(terms) / avg_length)
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                weight = idf[term] * tf * (self.K1 + 1) / (tf + norm)
+                postings.setdefault(term, []).append((doc, weight))
+            doc_mass.append(sum(idf[term] for term in counts))
+        
+        snapshot = _FaqSnapshot()
+        snapshot.answers = answers
+        snapshot.entry_terms = entry_terms
+        snapshot.doc_entries = doc_entries
+        snapshot.doc_mass = doc_mass
+        snapshot.postings = {term: tuple(items) for term, items in postings.items()}
+        snapshot.idf = idf
+        return snapshot
+
+    def _maybe_reload(self):
+        """Не чаще раза в reload_interval сверяет mtime файла; индекс строит один поток"""
+        now = time.monotonic()
+        if not self.path or now - self._checked_at < self.reload_interval:
+            return
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                return
+            if mtime != self._mtime:
+                # Испорченный файл не перечитывается, пока его снова не изменят
+                self._mtime = mtime
+                self.load()
+        finally:
+            self._reload_lock.release()
+
+    def lookup(self, text):
+        """Ответ из базы или None, если уверенного совпадения нет"""
+        self._maybe_reload()
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        started = time.perf_counter()
+        self.lookups += 1
+        terms = set(self.tokenize(text))
+        scores = {}
+        matched = {}
+        for term in terms:
+            for doc, weight in snapshot.postings.get(term, ()):
+                scores[doc] = scores.get(doc, 0.0) + weight
+                matched[doc] = matched.get(doc, 0.0) + snapshot.idf[term]
+        answer = None
+        if scores:
+            best = max(scores, key=scores.get)
+            entry = snapshot.doc_entries[best]
+            if scores[best] >= self.min_score and \
+                    matched[best] >= self.min_coverage * snapshot.doc_mass[best] and \
+                    terms <= snapshot.entry_terms[entry]:
+                answer = snapshot.answers[entry]
+                self.hits += 1
+        self.lookup_time += time.perf_counter() - started
+        return answer
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "enabled": snapshot is not None,
+            "path": self.path,
+            "answers": len(snapshot.answers) if snapshot else 0,
+            "questions": len(snapshot.doc_entries) if snapshot else 0,
+            "terms": len(snapshot.idf) if snapshot else 0,
+            "loaded_at": self.loaded_at,
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else None,
+            "avg_lookup_us": round(self.lookup_time / self.lookups * 1e6, 1) if self.lookups else None
+        }
+
+faq_index = FaqIndex(Config.FAQ_PATH, Config.FAQ_MIN_SCORE, Config.FAQ_MIN_COVERAGE, Config.FAQ_RELOAD_INTERVAL)
+
+# ПАМЯТЬ ДИАЛОГА ПО ЧАТАМ
+class _Turn:
+    __slots__ = ('question', 'answer', 'tokens')
+
+    def __init__(self, question, answer):
+        self.question = question
+        self.answer = answer
+        self.tokens = estimate_tokens(question) + estimate_tokens(answer)
+
+class _Dialogue:
+    __slots__ = ('turns', 'earlier', 'chars', 'touched')
+
+    def __init__(self, max_turns):
+        # Кольцевой буфер последних реплик; вытесненные вопросы остаются для краткой сводки
+        self.turns = deque(maxlen=max_turns)
+        self.earlier = deque(maxlen=5)
+        self.chars = 0
+        self.touched = 0.0
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов: для русского текста около трех символов на токен"""
+    return len(text) // 3 + 1
+
+class ConversationMemory:
+    """Последние реплики каждого чата для контекста следующего вопроса
+
+    Память ограничена сверху: max_turns реплик на чат, max_chats чатов и max_chars
+    символов на все чаты; при превышении и по истечении ttl простоя вытесняются
+    давно молчащие чаты (LRU). Перед запросом история урезается до бюджета токенов,
+    а не вошедшие в него вопросы по желанию сворачиваются в одну строку-сводку.
+
+    Состояние свое у каждого процесса. Под gunicorn -w N сообщения чата попадают в
+    разные воркеры, и уточнение видит историю примерно в 1/N случаев; для диалогов
+    с памятью запускайте один воркер (потоков в нем хватает: WORKER_THREADS) или
+    режим python app.py poll, где все обновления разбирает один процесс.
+    """
+
+    def __init__(self, max_turns, token_budget, max_chats, max_chars, ttl, answer_chars, summary):
+        self.max_turns = max(0, max_turns)
+        self.token_budget = token_budget
+        self.max_chats = max(1, max_chats)
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self.answer_chars = answer_chars
+        self.summary = summary
+        self._dialogues = OrderedDict()
+        self._lock = threading.Lock()
+        self.chars = 0
+        self.evictions = 0
+        self.trimmed = 0
+        self.summarized = 0
+
+    @property
+    def enabled(self):
+        return self.max_turns > 0
+
+    def context(self, chat_id):
+        """Сообщения истории для запроса: [сводка], затем пары user/assistant от старых к новым
+
+        Сводка возвращается как system-сообщение; _completion_request дописывает ее
+        к системному промпту, чтобы system оставалось единственным и первым.
+        """
+        if not self.enabled or chat_id is None:
+            return []
+        with self._lock:
+            dialogue = self._dialogues.get(chat_id)
+            if dialogue is None:
+                return []
+            if time.monotonic() - dialogue.touched > self.ttl:
+                self._drop(chat_id)
+                return []
+            self._dialogues.move_to_end(chat_id)
+            dialogue.touched = time.monotonic()
+            turns = list(dialogue.turns)
+            earlier = list(dialogue.earlier)
+
+        kept = []
+        budget = self.token_budget
+        for turn in reversed(turns):
+            if turn.tokens > budget:
+                break
+            budget -= turn.tokens
+            kept.append(turn)
+        kept.reverse()
+        dropped = turns[:len(turns) - len(kept)]
+        if dropped:
+            self.trimmed += 1
+
+        messages = []
+        if self.summary:
+            questions = earlier + [self._first_sentence(turn.question) for turn in dropped]
+            if questions:
+                self.summarized += 1
+                messages.append({"role": "system",
+                                 "content": "Ранее в диалоге пользователь спрашивал: " + "; ".join(questions)})
+        for turn in kept:
+            messages.append({"role": "user", "content": turn.question})
+            messages.append({"role": "assistant", "content": turn.answer})
+        return messages
+
+    def has_history(self, chat_id):
+        """Есть ли у чата непросроченная история; сама история при этом не продлевается"""
+        if not self.enabled or chat_id is None:
+            return False
+        with self._lock:
+            dialogue = self._dialogues.get(chat_id)
+            return dialogue is not None and time.monotonic() - dialogue.touched <= self.ttl
+
+    def add(self, chat_id, question, answer):
+        """Запоминает реплику; длинный ответ хранится в сокращенном виде"""
+        if not self.enabled or chat_id is None:
+            return
+        if len(answer) > self.answer_chars:
+            answer = answer[:self.answer_chars] + "…"
+        turn = _Turn(question, answer)
+        size = len(question) + len(answer)
+        with self._lock:
+            dialogue = self._dialogues.get(chat_id)
+            if dialogue is None:
+                dialogue = self._dialogues[chat_id] = _Dialogue(self.max_turns)
+            else:
+                self._dialogues.move_to_end(chat_id)
+            if len(dialogue.turns) == dialogue.turns.maxlen:
+                oldest = dialogue.turns[0]
+                self._account(dialogue, -(len(oldest.question) + len(oldest.answer)))
+                if self.summary:
+                    dialogue.earlier.append(self._first_sentence(oldest.question))
+            dialogue.turns.append(turn)
+            dialogue.touched = time.monotonic()
+            self._account(dialogue, size)
+            self._evict()
+
+    def discard_last(self, chat_id, question):
+        """Убирает последнюю реплику, если ответ на нее пользователю так и не ушел"""
+        with self._lock:
+            dialogue = self._dialogues.get(chat_id)
+            if dialogue is not None and dialogue.turns and dialogue.turns[-1].question == question:
+                turn = dialogue.turns.pop()
+                self._account(dialogue, -(len(turn.question) + len(turn.answer)))
+
+    def clear(self, chat_id):
+        with self._lock:
+            if chat_id in self._dialogues:
+                self._drop(chat_id)
+
+    def _account(self, dialogue, delta):
+        dialogue.chars += delta
+        self.chars += delta
+
+    def _drop(self, chat_id):
+        dialogue = self._dialogues.pop(chat_id)
+        self.chars -= dialogue.chars
+
+    def _evict(self):
+        """Вытесняет давно молчащие чаты: сверх лимитов или простоявшие дольше ttl"""
+        now = time.monotonic()
+        while self._dialogues:
+            chat_id, oldest = next(iter(self._dialogues.items()))
+            if len(self._dialogues) <= self.max_chats and self.chars <= self.max_chars and \
+                    now - oldest.touched <= self.ttl:
+                break
+            self._drop(chat_id)
+            self.evictions += 1
+
+    @staticmethod
+    def _first_sentence(text, limit=100):
+        text = ' '.join(text.split())
+        for mark in ('?', '.', '!'):
+            position = text.find(mark)
+            if 0 < position < limit:
+                return text[:position + 1]
+        return text if len(text) <= limit else text[:limit] + "…"
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "scope": "process",
+                "pid": os.getpid(),
+                "chats": len(self._dialogues),
+                "turns": sum(len(dialogue.turns) for dialogue in self._dialogues.values()),
+                "chars": self.chars,
+                "max_chars": self.max_chars,
+                "token_budget": self.token_budget,
+                "evictions": self.evictions,
+                "trimmed": self.trimmed,
+                "summarized": self.summarized
+            }
+
+conversation_memory = ConversationMemory(
+    Config.MEMORY_TURNS,
+    Config.MEMORY_TOKEN_BUDGET,
+    Config.MEMORY_MAX_CHATS,
+    Config.MEMORY_MAX_CHARS,
+    Config.MEMORY_TTL,
+    Config.MEMORY_ANSWER_CHARS,
+    Config.MEMORY_SUMMARY
+)
+
+# ДОПУСК ЗАПРОСОВ К GIGACHAT: ОБЩИЙ ЛИМИТ И ЧЕСТНАЯ ОЧЕРЕДЬ
+class BusyError(Exception):
+    """Очередь к GigaChat переполнена или ожидание затянулось"""
+
+class SharedSlots:
+    """Межпроцессный семафор: count файлов-слотов в каталоге, слот занят, пока на нем flock
+
+    Блокировка flock принадлежит открытому дескриптору, поэтому слоты делят и потоки
+    одного процесса, и воркеры gunicorn. Слот умершего процесса освобождает ядро.
+    Свободный слот ищется без ожидания; если все заняты - повтор через короткую паузу.
+    """
+
+    POLL_MIN = 0.01
+    POLL_MAX = 0.1
+
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = max(1, count)
+        self._checked = False
+        self.contended = 0
+
+    def enabled(self):
+        if self._checked:
+            return bool(self.directory)
+        if self.directory and fcntl is not None:
+            try:
+                ensure_private_dir(self.directory)
+            except OSError as e:
+                self.disable(e)
+        else:
+            self.directory = None
+        self._checked = True
+        return bool(self.directory)
+
+    def disable(self, error):
+        log.warning("Общий лимит GigaChat недоступен, лимит на процесс: %s", error)
+        self.directory = None
+
+    def acquire(self, max_wait):
+        """Возвращает дескриптор занятого слота или None, если за max_wait слот не освободился"""
+        deadline = time.monotonic() + max(0.0, max_wait)
+        pause = self.POLL_MIN
+        first = random.randrange(self.count)
+        while True:
+            for i in range(self.count):
+                fd = self._try_slot((first + i) % self.count)
+                if fd is not None:
+                    return fd
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.contended += 1
+            time.sleep(min(pause, remaining))
+            pause = min(pause * 2, self.POLL_MAX)
+
+    def _try_slot(self, index):
+        path = os.path.join(self.directory, f"slot-{index}.lock")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except OSError:
+            os.close(fd)
+            return None
+
+    @staticmethod
+    def release(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+class GigaChatAdmission:
+    """Не больше max_concurrency запросов к GigaChat одновременно
+
+    Ожидающие стоят в очередях по пользователям, а освободившийся слот отдается
+    пользователям по кругу - один активный пользователь не вытесняет остальных.
+    Очередь и круг свои у каждого процесса; общий для воркеров лимит держат
+    файлы-слоты SharedSlots, которые занимаются после местного слота. Без каталога
+    слотов (или без fcntl) лимит действует на каждый процесс отдельно.
+    """
+
+    def __init__(self, max_concurrency, per_user_queue, max_queued, max_wait, slots_dir=None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_user_queue = max(0, per_user_queue)
+        self.max_queued = max(0, max_queued)
+        self.max_wait = max_wait
+        self.shared = SharedSlots(slots_dir, self.max_concurrency) if slots_dir else None
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._queues = {}
+        self._round_robin = deque()
+        self._recent_waits = deque(maxlen=1000)
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @contextmanager
+    def slot(self, user_id, max_wait=None):
+        """Держит слот на время запроса; BusyError - если встать в очередь нельзя"""
+        max_wait = self.max_wait if max_wait is None else min(self.max_wait, max_wait)
+        started = time.monotonic()
+        self._acquire(user_id, max_wait)
+        shared_fd = None
+        try:
+            if self.shared is not None and self.shared.enabled():
+                try:
+                    shared_fd = self.shared.acquire(max_wait - (time.monotonic() - started))
+                except OSError as e:
+                    self.shared.disable(e)
+                else:
+                    if shared_fd is None:
+                        with self._lock:
+                            self.timeouts += 1
+                        raise BusyError(f"нет свободного общего слота из {self.max_concurrency}")
+            yield
+        finally:
+            if shared_fd is not None:
+                self.shared.release(shared_fd)
+            self._release()
+
+    def _acquire(self, user_id, max_wait):
+        started = time.monotonic()
+        with self._lock:
+            if self._active < self.max_concurrency and not self._round_robin:
+                self._active += 1
+                self._record_wait(0.0)
+                return
+            user_queue = self._queues.get(user_id)
+            if (user_queue is not None and len(user_queue) >= self.per_user_queue) or \
+                    self._queued >= self.max_queued or self.per_user_queue == 0:
+                self.rejected += 1
+                raise BusyError(f"очередь пользователя {user_id} заполнена")
+            if user_queue is None:
+                user_queue = self._queues[user_id] = deque()
+                self._round_robin.append(user_id)
+            granted = threading.Event()
+            user_queue.append(granted)
+            self._queued += 1
+        
+        if not granted.wait(max(0.0, max_wait)):
+            with self._lock:
+                # Слот мог достаться нам между таймаутом и захватом блокировки
+                if not granted.is_set():
+                    user_queue = self._queues.get(user_id)
+                    if user_queue is not None and granted in user_queue:
+                        user_queue.remove(granted)
+                        self._queued -= 1
+                        if not user_queue:
+                            del self._queues[user_id]
+                            self._round_robin.remove(user_id)
+                    self.timeouts += 1
+                    raise BusyError(f"ожидание дольше {max_wait:.1f} с")
+        with self._lock:
+            self._record_wait(time.monotonic() - started)
+
+    def _release(self):
+        with self._lock:
+            self._active -= 1
+            while self._active < self.max_concurrency and self._round_robin:
+                user_id = self._round_robin.popleft()
+                user_queue = self._queues[user_id]
+                granted = user_queue.popleft()
+                self._queued -= 1
+                if user_queue:
+                    # Пользователь с оставшимися запросами уходит в конец круга
+                    self._round_robin.append(user_id)
+                else:
+                    del self._queues[user_id]
+                self._active += 1
+                granted.set()
+
+    def _record_wait(self, waited):
+        GIGACHAT_ADMISSION_WAIT.observe(waited)
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self._recent_waits.append(waited)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._recent_waits)
+            percentile = lambda q: round(waits[min(len(waits) - 1, int(q * len(waits)))], 3) if waits else None
+            return {
+                "max_concurrency": self.max_concurrency,
+                "scope": "workers" if self.shared is not None and self.shared.directory else "process",
+                "shared_contended": self.shared.contended if self.shared is not None else 0,
+                "in_flight": self._active,
+                "queued": self._queued,
+                "users_waiting": len(self._queues),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "wait_avg": round(self.wait_total / self.admitted, 3) if self.admitted else None,
+                "wait_p50": percentile(0.5),
+                "wait_p95": percentile(0.95),
+                "wait_max": round(self.wait_max, 3)
+            }
+
+gigachat_admission = GigaChatAdmission(
+    Config.GIGACHAT_MAX_CONCURRENCY,
+    Config.GIGACHAT_USER_QUEUE,
+    Config.GIGACHAT_MAX_QUEUED,
+    Config.GIGACHAT_MAX_WAIT,
+    Config.GIGACHAT_SLOTS_DIR
+)
+
+# АВТОМАТ ОТКЛЮЧЕНИЯ И АДАПТИВНЫЕ ТАЙМАУТЫ GIGACHAT
+class CircuitOpenError(Exception):
+    """GigaChat признан недоступным - запрос не отправляется"""
+
+class CircuitBreaker:
+    """Автомат отключения: closed - запросы идут, open - сразу отказ, half_open - пробные запросы
+
+    Размыкается, когда за окно window секунд набралось не меньше min_calls вызовов и доля
+    ошибок или медленных (дольше slow_call секунд) вызовов достигла порога. Через
+    open_seconds пропускает до probes пробных запросов: успех замыкает цепь, сбой
+    снова размыкает. Состояние свое у каждого процесса.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window, min_calls, error_rate, slow_call, slow_rate, open_seconds, probes):
+        self.window = window
+        self.min_calls = max(1, min_calls)
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.probes = max(1, probes)
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._failures = 0
+        self._slow = 0
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self.opens = 0
+        self.rejected = 0
+
+    def check(self):
+        """Бросает CircuitOpenError, если сейчас запрос заведомо не пройдет; слот пробы не занимает"""
+        with self._lock:
+            self._refresh_state()
+            if self.state == self.OPEN or \
+                    (self.state == self.HALF_OPEN and self._probes_in_flight >= self.probes):
+                self.rejected += 1
+                raise CircuitOpenError(self.state)
+
+    def acquire(self):
+        """Разрешение на один вызов; в half_open занимает слот пробы до record()"""
+        with self._lock:
+            self._refresh_state()
+            if self.state == self.OPEN or \
+                    (self.state == self.HALF_OPEN and self._probes_in_flight >= self.probes):
+                self.rejected += 1
+                raise CircuitOpenError(self.state)
+            if self.state == self.HALF_OPEN:
+                self._probes_in_flight += 1
+                return True
+            return False
+
+    def record(self, success, duration, probe=False):
+        """Итог вызова: success - ответ получен и это не ошибка сервиса, duration - секунды"""
+        slow = duration >= self.slow_call
+        with self._lock:
+            if probe:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if self.state == self.HALF_OPEN:
+                    if success and not slow:
+                        log.info("GigaChat снова доступен, автомат замкнут")
+                        self._reset(self.CLOSED)
+                    else:
+                        self._open()
+                    return
+            if self.state != self.CLOSED:
+                return
+            now = time.monotonic()
+            self._calls.append((now, success, slow))
+            self._failures += not success
+            self._slow += slow
+            self._expire(now)
+            calls = len(self._calls)
+            if calls >= self.min_calls and (self._failures / calls >= self.error_rate or
+                                            self._slow / calls >= self.slow_rate):
+                self._open()
+
+    def _expire(self, now):
+        while self._calls and now - self._calls[0][0] > self.window:
+            _, success, slow = self._calls.popleft()
+            self._failures -= not success
+            self._slow -= slow
+
+    def _open(self):
+        log.warning("GigaChat недоступен: автомат разомкнут на %s с (ошибок %s, медленных %s из %s)",
+                    self.open_seconds, self._failures, self._slow, len(self._calls))
+        self._reset(self.OPEN)
+        self._opened_at = time.monotonic()
+        self.opens += 1
+
+    def _reset(self, state):
+        self.state = state
+        self._calls.clear()
+        self._failures = 0
+        self._slow = 0
+
+    def _refresh_state(self):
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self.state = self.HALF_OPEN
+            self._probes_in_flight = 0
+
+    def stats(self):
+        with self._lock:
+            self._refresh_state()
+            self._expire(time.monotonic())
+            return {
+                "state": self.state,
+                "calls": len(self._calls),
+                "failures": self._failures,
+                "slow": self._slow,
+                "opens": self.opens,
+                "rejected": self.rejected,
+                "open_for": round(max(0.0, self.open_seconds - (time.monotonic() - self._opened_at)), 1)
+                if self.state == self.OPEN else 0
+            }
+
+class AdaptiveTimeout:
+    """Таймаут попытки по наблюдаемой задержке: перцентиль последних ответов x множитель
+
+    Пока ответов меньше warmup, действует maximum. Результат всегда в [minimum, maximum].
+    """
+
+    def __init__(self, minimum, maximum, percentile, multiplier, samples=200, warmup=20):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.warmup = warmup
+        self._samples = deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def current(self):
+        with self._lock:
+            if len(self._samples) < self.warmup:
+                return self.maximum
+            ordered = sorted(self._samples)
+        observed = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        return min(self.maximum, max(self.minimum, observed * self.multiplier))
+
+gigachat_breaker = CircuitBreaker(
+    Config.GIGACHAT_BREAKER_WINDOW,
+    Config.GIGACHAT_BREAKER_MIN_CALLS,
+    Config.GIGACHAT_BREAKER_ERROR_RATE,
+    Config.GIGACHAT_BREAKER_SLOW_CALL,
+    Config.GIGACHAT_BREAKER_SLOW_RATE,
+    Config.GIGACHAT_BREAKER_OPEN_SECONDS,
+    Config.GIGACHAT_BREAKER_PROBES
+)
+# Обычный ответ приходит целиком, потоковый - считается до заголовков ответа
+gigachat_timeouts = {
+    kind: AdaptiveTimeout(Config.GIGACHAT_TIMEOUT_MIN, Config.GIGACHAT_TIMEOUT_MAX,
+                          Config.GIGACHAT_TIMEOUT_PERCENTILE, Config.GIGACHAT_TIMEOUT_MULTIPLIER)
+    for kind in ('full', 'stream')
+}
+
 # КЛАСС GIGACHAT С ПРАВИЛЬНОЙ ИНИЦИАЛИЗАЦИЕЙ
 class GigaChatBot:
     def __init__(self):
         self.is_configured = bool(GIGACHAT_AUTH)
-        self.base_url = "https://gigachat.devices.sberbank.ru/api/v1"
-        self.access_token = None
-        self.token_expires = 0
+        self.base_url = Config.GIGACHAT_API_URL
         
     def get_auth_token(self):
         """Получает токен авторизации для GigaChat"""
         try:
-            # Проверяем, не истек ли текущий токен
-            if self.access_token and time.time() < self.token_expires:
-                return self.access_token
-                
-            print("🔐 Получаем новый токен GigaChat...")
-            self.access_token = get_gigachat_token()
-            # Токен действует 30 минут, устанавливаем время истечения на 25 минут
-            self.token_expires = time.time() + 1500
-            return self.access_token
+            return token_manager.get_token()
             
         except Exception as e:
-            print(f"❌ Ошибка получения токена: {e}")
+            log.error("Ошибка получения токена: %s", e)
             return None
     
-    def _make_secure_request(self, method, url, **kwargs):
-        """Выполняет безопасный запрос с сертификатами"""
-        try:
-            verify_ssl = Config.CERT_PATH if Path(Config.CERT_PATH).exists() else False
-            kwargs['verify'] = verify_ssl
-            kwargs['timeout'] = Config.REQUEST_TIMEOUT
-            
-            response = requests.request(method, url, **kwargs)
-            return response
-        except Exception as e:
-            print(f"❌ Ошибка безопасного запроса: {e}")
-            # Пробуем без проверки SSL
+    def _make_secure_request(self, method, url, deadline=None, **kwargs):
+        """Запрос к GigaChat через автомат отключения с адаптивным таймаутом попытки
+
+        Сбой соединения, таймаут, 5xx и 429 повторяются, пока есть попытки и время до
+        deadline (time.monotonic()). CircuitOpenError - цепь разомкнута, запрос не отправлен.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + Config.GIGACHAT_DEADLINE
+        adaptive = gigachat_timeouts['stream' if kwargs.get('stream') else 'full']
+        timeout = adaptive.current()
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 1:
+                raise requests.exceptions.Timeout("дедлайн запроса к GigaChat исчерпан")
+            probe = gigachat_breaker.acquire()
+            attempt_timeout = min(timeout, remaining)
+            started = time.perf_counter()
+            # Итог попытки записывается в finally: иначе неожиданное исключение
+            # навсегда заняло бы слот пробы автомата в half_open
+            recorded = False
             try:
-                kwargs['verify'] = False
-                response = requests.request(method, url, **kwargs)
-                print("⚠️  Запрос выполнен без проверки SSL")
-                return response
-            except Exception as e2:
-                print(f"❌ Критическая ошибка запроса: {e2}")
+                try:
+                    response = self._send(method, url, deadline, timeout=attempt_timeout, **kwargs)
+                except requests.exceptions.RequestException as e:
+                    elapsed = time.perf_counter() - started
+                    GIGACHAT_REQUEST_DURATION.observe(elapsed, "error")
+                    gigachat_breaker.record(False, elapsed, probe)
+                    recorded = True
+                    if isinstance(e, requests.exceptions.Timeout):
+                        # Ответа не дождались: задержка не меньше таймаута, следующей попытке - вдвое больше
+                        adaptive.observe(attempt_timeout)
+                        timeout = min(adaptive.maximum, attempt_timeout * 2)
+                    retriable = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+                    if not retriable or attempt >= Config.GIGACHAT_ATTEMPTS:
+                        raise
+                    log.warning("Попытка %s запроса к GigaChat не удалась: %s", attempt, e)
+                    continue
+                
+                elapsed = time.perf_counter() - started
+                GIGACHAT_REQUEST_DURATION.observe(elapsed, str(response.status_code))
+                failed = response.status_code >= 500 or response.status_code == 429
+                gigachat_breaker.record(not failed, elapsed, probe)
+                recorded = True
+            finally:
+                if not recorded:
+                    gigachat_breaker.record(False, time.perf_counter() - started, probe)
+            if failed:
+                pause = self._retry_pause(response)
+                if attempt < Config.GIGACHAT_ATTEMPTS and pause < deadline - time.monotonic() - 1:
+                    log.warning("Попытка %s запроса к GigaChat: статус %s, повтор через %s с",
+                                attempt, response.status_code, pause, extra={"status": response.status_code})
+                    response.close()
+                    time.sleep(pause)
+                    continue
+            else:
+                adaptive.observe(elapsed)
+            return response
+    
+    @staticmethod
+    def _retry_pause(response):
+        """Пауза перед повтором: Retry-After для 429 (не больше 5 с), иначе полсекунды"""
+        try:
+            return min(5.0, max(0.0, float(response.headers.get('Retry-After', 0.5))))
+        except ValueError:
+            return 0.5
+    
+    def _send(self, method, url, deadline, **kwargs):
+        """Один HTTP-запрос; без проверки SSL повторяется только при ошибке сертификата и в пределах deadline"""
+        try:
+            return gigachat_http.request(method, url, **kwargs)
+        except requests.exceptions.SSLError as e:
+            remaining = deadline - time.monotonic()
+            if kwargs.get('verify') is False or remaining <= 1:
                 raise
+            log.warning("Ошибка проверки сертификата GigaChat: %s; повтор без проверки SSL", e)
+            kwargs['verify'] = False
+            kwargs['timeout'] = min(kwargs.get('timeout') or remaining, remaining)
+            return gigachat_http.request(method, url, **kwargs)
+    
+    def _completion_request(self, auth_token, user_message, stream=False, history=()):
+        """Собирает URL, заголовки и тело запроса chat/completions; history - прежние реплики чата"""
+        url = f"{self.base_url}/chat/completions"
+        # GigaChat ждет системный промпт только первым сообщением: сводка истории идет в него
+        system_prompt = SYSTEM_PROMPT
+        dialogue = []
+        for message in history:
+            if message["role"] == "system":
+                system_prompt += "\n\n" + message["content"]
+            else:
+                dialogue.append(message)
+        headers = {
+            'Authorization': f'Bearer {auth_token}',
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream' if stream else 'application/json'
+        }
+        
+        data = {
+            "model": Config.GIGACHAT_MODEL,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                *dialogue,
+                {
+                    "role": "user", 
+                    "content": user_message
+                }
+            ],
+            "temperature": Config.GIGACHAT_TEMPERATURE,
+            "max_tokens": Config.GIGACHAT_MAX_TOKENS
+        }
+        if stream:
+            data["stream"] = True
+        return url, headers, data
+    
+    def _cache_key(self, user_message):
+        params = {
+            "model": Config.GIGACHAT_MODEL,
+            "temperature": Config.GIGACHAT_TEMPERATURE,
+            "max_tokens": Config.GIGACHAT_MAX_TOKENS
+        }
+        return response_cache.make_key(user_message, SYSTEM_PROMPT, params)
     
-    def get_response(self, user_message):
-        """Получает ответ от GigaChat"""
+    def _error_message(self, response, auth_token):
+        """Текст для пользователя по неуспешному ответу GigaChat"""
+        if response.status_code == 401:
+            log.error("Ошибка 401: Неавторизован", extra={"status": 401})
+            # Сбрасываем токен при ошибке авторизации
+            token_manager.invalidate(auth_token)
+            return "❌ Ошибка авторизации GigaChat. Попробуйте еще раз."
+        elif response.status_code == 403:
+            log.error("Ошибка 403: Доступ запрещен", extra={"status": 403})
+            return "❌ Доступ к GigaChat запрещен. Проверьте права доступа API ключа."
+        else:
+            log.error("Ошибка GigaChat API: %s - %s", response.status_code, response.text,
+                      extra={"status": response.status_code})
+            return f"❌ Ошибка GigaChat API ({response.status_code}). Попробуйте позже."
+    
+    def get_response(self, user_message, user_id=None, chat_id=None):
+        """Получает ответ от GigaChat; с chat_id вопрос задается в контексте диалога чата"""
         if not self.is_configured:
-            return "❌ GigaChat не настроен. Добавьте GIGACHAT_AUTH в настройках Render."
+            return NOT_CONFIGURED_MESSAGE
+        
+        # Повторный вопрос отдаем из кэша без токена и запроса к модели;
+        # ответ на вопрос с историей зависит от нее и в кэш не попадает
+        history = conversation_memory.context(chat_id)
+        cache_key = None if history else self._cache_key(user_message)
+        cached = response_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            log.info("Ответ из кэша", extra={"chars": len(cached), "user_id": user_id, "sampled": True})
+            conversation_memory.add(chat_id, user_message, cached)
+            return cached
         
+        deadline = time.monotonic() + Config.GIGACHAT_DEADLINE
+        try:
+            # При разомкнутой цепи отказываем сразу, не занимая место в очереди
+            gigachat_breaker.check()
+            with gigachat_admission.slot(user_id, deadline - time.monotonic()):
+                return self._fetch_response(user_message, cache_key, deadline, chat_id, history)
+        except BusyError as e:
+            log.warning("GigaChat занят: %s", e, extra={"user_id": user_id})
+            return BUSY_MESSAGE
+        except CircuitOpenError:
+            return UNAVAILABLE_MESSAGE
+    
+    def _fetch_response(self, user_message, cache_key, deadline, chat_id=None, history=()):
+        """Запрос chat/completions; вызывается внутри слота допуска"""
         try:
             auth_token = self.get_auth_token()
             if not auth_token:
-                error_msg = """
-❌ Не удалось авторизоваться в GigaChat. 
+                return AUTH_ERROR_MESSAGE
+            
+            url, headers, data = self._completion_request(auth_token, user_message, history=history)
+            
+            log.debug("Отправка запроса к GigaChat: %s", user_message[:100])
+            started = time.perf_counter()
+            
+            response = self._make_secure_request('POST', url, deadline, headers=headers, json=data)
+            
+            if response.status_code == 200:
+                result = response.json()
+                chat_response = result['choices'][0]['message']['content']
+                log.info("Ответ GigaChat получен", extra={"chars": len(chat_response), "status": 200, "sampled": True,
+                                                          "latency_ms": round((time.perf_counter() - started) * 1000)})
+                if cache_key:
+                    response_cache.put(cache_key, chat_response)
+                conversation_memory.add(chat_id, user_message, chat_response)
+                return chat_response
+            return self._error_message(response, auth_token)
+            
+        except CircuitOpenError:
+            raise
+        except requests.exceptions.RequestException as e:
+            log.error("Ошибка сети GigaChat: %s", e)
+            return CONNECTION_ERROR_MESSAGE
+        except Exception as e:
+            log.exception("Общая ошибка GigaChat: %s", e)
+            return f"❌ Ошибка обработки запроса: {str(e)}"
+    
+    def stream_response(self, user_message, user_id=None, chat_id=None):
+        """Потоковый ответ GigaChat: генератор фрагментов текста по мере генерации"""
+        if not self.is_configured:
+            yield NOT_CONFIGURED_MESSAGE
+            return
+        
+        history = conversation_memory.context(chat_id)
+        cache_key = None if history else self._cache_key(user_message)
+        cached = response_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            log.info("Ответ из кэша", extra={"chars": len(cached), "user_id": user_id, "sampled": True})
+            conversation_memory.add(chat_id, user_message, cached)
+            yield cached
+            return
+        
+        deadline = time.monotonic() + Config.GIGACHAT_DEADLINE
+        try:
+            gigachat_breaker.check()
+            with gigachat_admission.slot(user_id, deadline - time.monotonic()):
+                yield from self._stream_completion(user_message, cache_key, deadline, chat_id, history)
+        except BusyError as e:
+            log.warning("GigaChat занят: %s", e, extra={"user_id": user_id})
+            yield BUSY_MESSAGE
+        except CircuitOpenError:
+            yield UNAVAILABLE_MESSAGE
+    
+    def _stream_completion(self, user_message, cache_key, deadline, chat_id=None, history=()):
+        """Потоковый запрос chat/completions; вызывается внутри слота допуска"""
+        auth_token = self.get_auth_token()
+        if not auth_token:
+            yield AUTH_ERROR_MESSAGE
+            return
+        
+        url, headers, data = self._completion_request(auth_token, user_message, stream=True, history=history)
+        log.debug("Потоковый запрос к GigaChat: %s", user_message[:100])
+        started = time.perf_counter()
+        
+        parts = []
+        received = 0
+        try:
+            # Дедлайн ограничивает ожидание начала ответа; дальше таймаут действует между фрагментами
+            response = self._make_secure_request('POST', url, deadline, headers=headers, json=data, stream=True)
+            with response:
+                log.debug("Статус ответа GigaChat: %s", response.status_code)
+                if response.status_code != 200:
+                    yield self._error_message(response, auth_token)
+                    return
+                
+                for event in self._iter_sse_data(response):
+                    if event == '[DONE]':
+                        break
+                    try:
+                        chunk = json.loads(event)
+                    except ValueError:
+                        continue
+                    choices = chunk.get('choices') or [{}]
+                    delta = choices[0].get('delta', {}).get('content')
+                    if delta:
+                        received += len(delta)
+                        parts.append(delta)
+                        yield delta
+            log.info("Потоковый ответ GigaChat получен", extra={"chars": received, "status": 200, "sampled": True,
+                                                                  "latency_ms": round((time.perf_counter() - started) * 1000)})
+            answer = ''.join(parts)
+            if cache_key:
+                response_cache.put(cache_key, answer)
+            conversation_memory.add(chat_id, user_message, answer)
+            
+        except requests.exceptions.RequestException as e:
+            log.error("Ошибка сети GigaChat: %s", e)
+            yield "\n\n" + CONNECTION_ERROR_MESSAGE if received else CONNECTION_ERROR_MESSAGE
+    
+    @staticmethod
+    def _iter_sse_data(response):
+        """Инкрементально разбирает поток SSE и отдает содержимое строк data:"""
+        buffer = b''
+        for block in response.iter_content(chunk_size=None):
+            buffer += block
+            start = 0
+            while True:
+                end = buffer.find(b'\n', start)
+                if end == -1:
+                    break
+                line = buffer[start:end].rstrip(b'\r')
+                start = end + 1
+                if line.startswith(b'data:'):
+                    yield line[5:].strip().decode('utf-8')
+            buffer = buffer[start:]
+
+# Клиент GigaChat создается лениво - при первом обращении, а не при импорте
+_gigachat = None
+_gigachat_lock = threading.Lock()
+
+def get_gigachat():
+    """Возвращает клиент GigaChat, при первом вызове загружая сертификат"""
+    global _gigachat
+    if _gigachat is None:
+        with _gigachat_lock:
+            if _gigachat is None:
+                try:
+                    download_certificate()
+                    log.info("GigaChat инициализирован")
+                except Exception as e:
+                    log.error("Ошибка инициализации: %s", e)
+                _gigachat = GigaChatBot()
+    return _gigachat
+
+# ФОНОВАЯ ПРОВЕРКА ДОСТУПНОСТИ СЕРВИСОВ
+class HealthProber:
+    """Периодически проверяет OAuth, GigaChat и Telegram самыми дешевыми запросами
+
+    OAuth - наличие действующего токена (менеджер обновит его при необходимости),
+    GigaChat - GET /models без генерации текста, Telegram - getMe. Результаты с историей
+    последних проверок отдаются из памяти: /status, /test_gigachat и главная страница
+    не обращаются к сервисам сами. Поток проверки свой у каждого процесса.
+    """
+
+    CHECKS = ('oauth', 'gigachat', 'telegram')
+
+    def __init__(self, interval, timeout, history):
+        self.interval = interval
+        self.timeout = timeout
+        self._history = {name: deque(maxlen=max(1, history)) for name in self.CHECKS}
+        self._last = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self.bot_username = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._probe_loop, name="health-prober", daemon=True).start()
+
+    def _probe_loop(self):
+        while True:
+            self.probe_all()
+            time.sleep(self.interval)
+
+    def probe_all(self):
+        for name in self.CHECKS:
+            started = time.perf_counter()
+            try:
+                ok, detail = getattr(self, f"_check_{name}")()
+            except Exception as e:
+                ok, detail = False, str(e)
+            self._record(name, ok, time.perf_counter() - started, detail)
+
+    def _check_oauth(self):
+        if not GIGACHAT_AUTH:
+            return False, "GIGACHAT_AUTH не задан"
+        token = token_manager.get_token()
+        expires_in = token_manager.stats()["expires_in"]
+        return bool(token), f"токен действует еще {expires_in} с" if token else "токен не получен"
+
+    def _check_gigachat(self):
+        if not GIGACHAT_AUTH:
+            return False, "GIGACHAT_AUTH не задан"
+        token = token_manager.get_token()
+        if not token:
+            return False, "нет токена"
+        response = gigachat_http.get(f"{Config.GIGACHAT_API_URL}/models", timeout=self.timeout,
+                                     headers={'Authorization': f'Bearer {token}', 'Accept': 'application/json'})
+        if response.status_code == 401:
+            token_manager.invalidate(token)
+        if response.status_code != 200:
+            return False, f"HTTP {response.status_code}"
+        models = [model.get("id") for model in response.json().get("data", [])]
+        return True, f"моделей: {len(models)}"
+
+    def _check_telegram(self):
+        response = telegram_http.post(telegram_url("getMe"), timeout=self.timeout)
+        data = response.json()
+        if not data.get("ok"):
+            return False, data.get("description") or f"HTTP {response.status_code}"
+        self.bot_username = data["result"].get("username")
+        return True, f"@{self.bot_username}"
+
+    def _record(self, name, ok, elapsed, detail):
+        result = {
+            "ok": ok,
+            "latency_ms": round(elapsed * 1000, 1),
+            "checked_at": round(time.time(), 1),
+            "detail": detail
+        }
+        with self._lock:
+            previous = self._last.get(name)
+            self._last[name] = result
+            self._history[name].append((ok, elapsed))
+        if previous is None or previous["ok"] != ok:
+            (log.info if ok else log.warning)("Проверка %s: %s (%s)", name, "доступен" if ok else "недоступен", detail)
+
+    def results(self):
+        """Последние результаты и сводка по истории; ok=None - проверки еще не было"""
+        with self._lock:
+            summary = {}
+            for name in self.CHECKS:
+                history = list(self._history[name])
+                latencies = sorted(elapsed for _, elapsed in history)
+                summary[name] = dict(self._last.get(name) or {"ok": None}, **{
+                    "success_rate": round(sum(ok for ok, _ in history) / len(history), 3) if history else None,
+                    "latency_p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+                    "latency_max_ms": round(latencies[-1] * 1000, 1) if latencies else None,
+                    "probes": len(history)
+                })
+            return summary
+
+    @staticmethod
+    def mark(result):
+        return {True: "✅", False: "❌"}.get(result["ok"], "⏳")
+
+health_prober = HealthProber(Config.HEALTH_INTERVAL, Config.HEALTH_TIMEOUT, Config.HEALTH_HISTORY)
+
+# ПЛАНИРОВЩИК ИСХОДЯЩИХ СООБЩЕНИЙ TELEGRAM
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity"""
 
-Возможные причины:
-1. Неверный GIGACHAT_AUTH в настройках Render
-2. Ключ не активирован в личном кабинете SberBank AI
-3. Проблемы с сертификатами
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
 
-💡 Для получения GIGACHAT_AUTH:
-1. Перейдите на https://developers.sber.ru/studio/auth
-2. Авторизуйтесь через СберID
-3. Создайте новое приложение
-4. Получите Client ID и Client Secret
-5. Используйте их в формате base64(ClientID:ClientSecret)
-"""
-                return error_msg
-            
-            # Создаем промпт для специализации на международных отношениях
-            system_prompt = """Ты - эксперт в области международных отношений. Твоя специализация включает:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
 
-🎓 **Образование и поступление:**
-- Вузы для международных отношений (МГИМО, МГУ, СПбГУ, ВШЭ, РУДН)
-- Вступительные экзамены и требования
-- Программы обучения и специализации
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
 
-📚 **Основные понятия:**
-- Дипломатия и внешняя политика
-- Международное право
-- Геополитика и международная безопасность
-- Глобализация и международные экономические отношения
+    def delay(self, now):
+        """Сколько секунд ждать до появления токена (0 - можно сейчас)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
 
-💼 **Карьера:**
-- Дипломатическая служба
-- Международные организации (ООН, НАТО, ЕС, ВТО, МВФ)
-- Международный бизнес
-- Аналитические центры и СМИ
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
 
-🌍 **Практические аспекты:**
-- Современные международные конфликты
-- Международные договоры и соглашения
-- Внешняя политика России и других стран
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
 
-Отвечай подробно, информативно, с конкретными примерами и практическими советами. Структурируй ответы для лучшего восприятия."""
+JSON_HEADERS = {'Content-Type': 'application/json'}
 
-            url = f"{self.base_url}/chat/completions"
-            headers = {
-                'Authorization': f'Bearer {auth_token}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            }
-            
-            data = {
-                "model": "GigaChat",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": system_prompt
-                    },
-                    {
-                        "role": "user", 
-                        "content": user_message
-                    }
-                ],
-                "temperature": 0.7,
-                "max_tokens": 2000
-            }
-            
-            print(f"🧠 Отправка запроса к GigaChat: {user_message[:100]}...")
-            
-            response = self._make_secure_request('POST', url, headers=headers, json=data)
-            
-            print(f"🧠 Статус ответа GigaChat: {response.status_code}")
-            
+class _OutboundMessage:
+    __slots__ = ('method', 'payload', 'future', 'attempts')
+
+    def __init__(self, method, payload):
+        self.method = method
+        self.payload = payload
+        self.future = Future()
+        self.attempts = 0
+
+    def fields(self):
+        """Тело вызова словарем, даже если оно уже сериализовано в bytes"""
+        return json.loads(self.payload) if isinstance(self.payload, bytes) else self.payload
+
+class TelegramSendScheduler:
+    """Очередь исходящих вызовов Bot API с лимитами Telegram и порядком внутри чата
+
+    Глобальный лимит и лимит на чат - корзины токенов. В каждом чате одновременно
+    выполняется не больше одного вызова, поэтому части длинного ответа приходят по порядку,
+    а повтор после 429 (retry_after) встает в начало очереди своего чата.
+    """
+
+    def __init__(self, global_rate, chat_rate, group_rate_per_minute, burst, senders, max_retries):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.senders = max(1, senders)
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._ready = deque()
+        self._in_flight = set()
+        self._buckets = {}
+        self._not_before = {}
+        self._global = TokenBucket(global_rate, max(1, global_rate))
+        self._executor = None
+        self._pid = None
+        self._last_prune = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttled = 0
+
+    def submit(self, chat_id, method, payload):
+        """Ставит вызов в очередь чата и сразу возвращает Future с полем result ответа
+
+        payload - словарь или уже сериализованное JSON-тело (bytes).
+        """
+        self._ensure_started()
+        message = _OutboundMessage(method, payload)
+        with self._cond:
+            chat_queue = self._queues.get(chat_id)
+            if chat_queue is None:
+                chat_queue = self._queues[chat_id] = deque()
+                self._ready.append(chat_id)
+            chat_queue.append(message)
+            self._cond.notify()
+        return message.future
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix="telegram-send")
+            self._pid = os.getpid()
+            threading.Thread(target=self._schedule_loop, name="telegram-scheduler", daemon=True).start()
+        register_shutdown_drain()
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный chat_id - группы и каналы, у них лимит строже
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    def _schedule_loop(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = None
+                chosen = None
+                for _ in range(len(self._ready)):
+                    chat_id = self._ready[0]
+                    self._ready.rotate(-1)
+                    if chat_id in self._in_flight:
+                        continue
+                    delay = max(self._not_before.get(chat_id, 0.0) - now, self._bucket(chat_id).delay(now))
+                    if delay > 0:
+                        wait = delay if wait is None else min(wait, delay)
+                        continue
+                    chosen = chat_id
+                    break
+                if chosen is None:
+                    self._prune(now)
+                    self._cond.wait(wait)
+                    continue
+                global_delay = self._global.delay(now)
+                if global_delay > 0:
+                    self._cond.wait(global_delay)
+                    continue
+
+                self._global.take(now)
+                self._bucket(chosen).take(now)
+                chat_queue = self._queues[chosen]
+                message = chat_queue.popleft()
+                if not chat_queue:
+                    del self._queues[chosen]
+                    self._ready.remove(chosen)
+                self._in_flight.add(chosen)
+                try:
+                    self._executor.submit(self._deliver, chosen, message)
+                except RuntimeError:
+                    # Интерпретатор завершается (дообработка в atexit): пул потоков уже не
+                    # принимает задачи, оставшиеся сообщения уходят в отдельных потоках
+                    threading.Thread(target=self._deliver, args=(chosen, message), daemon=True).start()
+
+    def _prune(self, now):
+        """Удаляет полные корзины простаивающих чатов, чтобы словарь не рос бесконечно"""
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for chat_id in [c for c, b in self._buckets.items()
+                        if c not in self._queues and c not in self._in_flight and b.is_full(now)]:
+            del self._buckets[chat_id]
+            self._not_before.pop(chat_id, None)
+
+    def _deliver(self, chat_id, message):
+        message.attempts += 1
+        retry_delay = None
+        result = None
+        started = time.perf_counter()
+        try:
+            url = telegram_url(message.method)
+            if isinstance(message.payload, bytes):
+                # Готовое JSON-тело (ReplyTemplate) уходит как есть, без повторной сериализации
+                response = telegram_http.post(url, data=message.payload, headers=JSON_HEADERS, timeout=10)
+            else:
+                response = telegram_http.post(url, json=message.payload, timeout=10)
+            TELEGRAM_SEND_DURATION.observe(time.perf_counter() - started, message.method, str(response.status_code))
             if response.status_code == 200:
-                result = response.json()
-                chat_response = result['choices'][0]['message']['content']
-                print(f"✅ Ответ GigaChat получен: {len(chat_response)} символов")
-                return chat_response
-            elif response.status_code == 401:
-                print("❌ Ошибка 401: Неавторизован")
-                # Сбрасываем токен при ошибке авторизации
-                self.access_token = None
-                return "❌ Ошибка авторизации GigaChat. Попробуйте еще раз."
-            elif response.status_code == 403:
-                print("❌ Ошибка 403: Доступ запрещен")
-                return "❌ Доступ к GigaChat запрещен. Проверьте права доступа API ключа."
+                result = response.json().get("result") or {}
+            elif response.status_code == 429:
+                self.throttled += 1
+                TELEGRAM_THROTTLED.inc(message.method)
+                retry_after = (response.json().get("parameters") or {}).get("retry_after", 1)
+                log.warning("Telegram 429: повтор через %s с", retry_after,
+                            extra={"chat_id": chat_id, "method": message.method, "status": 429})
+                retry_delay = float(retry_after)
+            elif response.status_code >= 500:
+                log.error("Ошибка Telegram API: %s", response.status_code,
+                          extra={"chat_id": chat_id, "method": message.method, "status": response.status_code})
+                retry_delay = min(30.0, 2.0 ** message.attempts)
+            elif response.status_code == 400 and "parse" in response.text and message.fields().get("parse_mode"):
+                # Telegram не разобрал HTML-разметку - отправляем ту же часть простым текстом
+                log.warning("Разметка отклонена, отправляем без parse_mode: %s", response.text,
+                            extra={"chat_id": chat_id, "method": message.method})
+                message.payload = {k: v for k, v in message.fields().items() if k != "parse_mode"}
+                retry_delay = 0.0
             else:
-                print(f"❌ Ошибка GigaChat API: {response.status_code} - {response.text}")
-                return f"❌ Ошибка GigaChat API ({response.status_code}). Попробуйте позже."
-            
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Ошибка сети GigaChat: {e}")
-            return "❌ Ошибка соединения с GigaChat. Попробуйте позже."
+                log.error("Ошибка Telegram API: %s", response.text,
+                          extra={"chat_id": chat_id, "method": message.method, "status": response.status_code})
         except Exception as e:
-            print(f"❌ Общая ошибка GigaChat: {e}")
-            return f"❌ Ошибка обработки запроса: {str(e)}"
+            TELEGRAM_SEND_DURATION.observe(time.perf_counter() - started, message.method, "error")
+            log.error("Ошибка отправки: %s", e, extra={"chat_id": chat_id, "method": message.method})
+            retry_delay = min(30.0, 2.0 ** message.attempts)
 
-# Инициализируем сертификаты и GigaChat
-try:
-    download_certificate()
-    gigachat = GigaChatBot()
-    print("✅ GigaChat инициализирован")
-except Exception as e:
-    print(f"❌ Ошибка инициализации: {e}")
-    gigachat = GigaChatBot()
+        if retry_delay is not None and message.attempts > self.max_retries:
+            log.error("Сообщение не отправлено после %s попыток", message.attempts,
+                      extra={"chat_id": chat_id, "method": message.method})
+            retry_delay = None
+
+        with self._cond:
+            self._in_flight.discard(chat_id)
+            if retry_delay is not None:
+                self.retries += 1
+                chat_queue = self._queues.get(chat_id)
+                if chat_queue is None:
+                    chat_queue = self._queues[chat_id] = deque()
+                    self._ready.append(chat_id)
+                chat_queue.appendleft(message)
+                self._not_before[chat_id] = time.monotonic() + retry_delay
+            elif result is not None:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._cond.notify()
+
+        if retry_delay is None:
+            message.future.set_result(result)
+
+    def pending(self):
+        """Вызовы, еще не завершенные: в очередях чатов и выполняющиеся"""
+        with self._cond:
+            return sum(len(q) for q in self._queues.values()) + len(self._in_flight)
+
+    def stats(self):
+        with self._cond:
+            queued = sum(len(q) for q in self._queues.values())
+            return {
+                "global_rate": self.global_rate,
+                "chat_rate": self.chat_rate,
+                "group_rate_per_minute": round(self.group_rate * 60, 2),
+                "queued": queued,
+                "chats_waiting": len(self._queues),
+                "in_flight": len(self._in_flight),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retries": self.retries,
+                "throttled_429": self.throttled
+            }
+
+telegram_sender = TelegramSendScheduler(
+    Config.TELEGRAM_GLOBAL_RATE,
+    Config.TELEGRAM_CHAT_RATE,
+    Config.TELEGRAM_GROUP_RATE_PER_MINUTE,
+    Config.TELEGRAM_CHAT_BURST,
+    Config.TELEGRAM_SENDER_THREADS,
+    Config.TELEGRAM_SEND_RETRIES
+)
+
+# РАЗБИЕНИЕ ДЛИННЫХ СООБЩЕНИЙ С УЧЕТОМ HTML-РАЗМЕТКИ
+_HTML_TAG = re.compile(r'<(/?)([a-zA-Z][\w-]*)[^<>]*>')
+_HTML_ENTITY = re.compile(r'&(?:#\d+|#x[0-9a-fA-F]+|[a-zA-Z]\w*);')
+
+# Границы разбиения в порядке предпочтения: абзац, строка, предложение, слово
+_SPLIT_LEVELS = (('\n\n',), ('\n',), ('. ', '! ', '? ', '… '), (' ',))
+
+# Дальше этого тег или сущность от точки разреза не ищем
+_MARKUP_LOOKBEHIND = 512
+
+def _markup_start(text, pos):
+    """Начало тега или сущности, внутри которых оказалась позиция pos, иначе None"""
+    lo = max(0, pos - _MARKUP_LOOKBEHIND)
+    open_pos = text.rfind('<', lo, pos)
+    if open_pos != -1 and text.rfind('>', open_pos, pos) == -1:
+        match = _HTML_TAG.match(text, open_pos)
+        if match and match.end() > pos:
+            return open_pos
+    amp_pos = text.rfind('&', max(lo, pos - 12), pos)
+    if amp_pos != -1:
+        match = _HTML_ENTITY.match(text, amp_pos)
+        if match and match.end() > pos:
+            return amp_pos
+    return None
+
+def _closing_tags(stack):
+    return ''.join(f'</{name}>' for name, _ in reversed(stack))
+
+def _apply_tags(stack, text, start, end):
+    """Обновляет стек открытых тегов по тегам из text[start:end]"""
+    for match in _HTML_TAG.finditer(text, start, end):
+        name = match.group(2).lower()
+        if not match.group(1):
+            stack.append((name, match.group(0)))
+        elif any(open_name == name for open_name, _ in stack):
+            while stack:
+                if stack.pop()[0] == name:
+                    break
+    return stack
+
+def _find_cut(text, lo, hi):
+    """Лучшая граница в text[lo:hi]: абзац, строка, предложение, слово, иначе hi"""
+    for separators in _SPLIT_LEVELS:
+        window_end = hi
+        while window_end > lo:
+            pos = max(text.rfind(sep, lo, window_end) for sep in separators)
+            if pos == -1:
+                break
+            # Режем после знака препинания, но перед пробелом или переводом строки
+            cut = pos + 1 if text[pos] in '.!?…' else pos
+            markup_start = _markup_start(text, cut)
+            if markup_start is None:
+                return cut
+            window_end = markup_start
+    markup_start = _markup_start(text, hi)
+    return hi if markup_start is None or markup_start <= lo else markup_start
+
+def split_message(text, limit=4000):
+    """Делит текст на части не длиннее limit, проходя его по индексам без копирования хвоста
+
+    Граница выбирается по абзацу, затем по предложению, затем по слову, и никогда не
+    попадает внутрь тега или HTML-сущности. Теги, открытые на границе, закрываются
+    в конце части и открываются заново в начале следующей.
+    """
+    if len(text) <= limit:
+        return [text]
+    
+    parts = []
+    stack = []
+    start = 0
+    length = len(text)
+    while start < length:
+        prefix = ''.join(raw for _, raw in stack)
+        if len(prefix) + length - start <= limit:
+            parts.append(prefix + text[start:])
+            break
+        
+        budget = limit - len(prefix)
+        reserve = len(_closing_tags(stack))
+        while True:
+            hi = start + max(1, budget - reserve)
+            # Не меньше половины бюджета на часть - так каждый символ просматривается O(1) раз
+            cut = _find_cut(text, start + (hi - start) // 2, hi)
+            cut_stack = _apply_tags(list(stack), text, start, cut)
+            closing = _closing_tags(cut_stack)
+            if cut - start + len(closing) <= budget or budget - reserve <= 1:
+                break
+            reserve = len(closing)
+        
+        body = text[start:cut].rstrip()
+        if body:
+            parts.append(prefix + body + closing)
+        stack = cut_stack
+        start = cut
+        while start < length and text[start].isspace():
+            start += 1
+    return parts
 
 # ФУНКЦИЯ ДЛЯ ОТПРАВКИ СООБЩЕНИЙ ЧЕРЕЗ API TELEGRAM
 def send_telegram_message(chat_id, text):
-    """Отправляет сообщение через Telegram Bot API"""
+    """Ставит сообщение в очередь отправки; длинный текст делится на части"""
     try:
         max_length = 4000
         if len(text) > max_length:
-            parts = []
-            while text:
-                if len(text) <= max_length:
-                    parts.append(text)
-                    break
-                else:
-                    split_pos = text.rfind('\n', 0, max_length)
-                    if split_pos == -1:
-                        split_pos = text.rfind('. ', 0, max_length)
-                    if split_pos == -1:
-                        split_pos = text.rfind(' ', 0, max_length)
-                    if split_pos == -1:
-                        split_pos = max_length
-                    
-                    parts.append(text[:split_pos])
-                    text = text[split_pos:].lstrip()
-            
+            parts = split_message(text, max_length)
             for i, part in enumerate(parts):
                 part_text = f"{part}\n\n({i+1}/{len(parts)})"
-                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-                data = {
+                telegram_sender.submit(chat_id, "sendMessage", {
                     "chat_id": chat_id,
                     "text": part_text,
                     "parse_mode": "HTML"
-                }
-                response = requests.post(url, json=data, timeout=10)
-                if response.status_code != 200:
-                    print(f"❌ Ошибка отправки части {i+1}: {response.text}")
-                time.sleep(0.5)
+                })
             return True
         else:
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-            data = {
+            telegram_sender.submit(chat_id, "sendMessage", {
                 "chat_id": chat_id,
                 "text": text,
                 "parse_mode": "HTML"
-            }
-            response = requests.post(url, json=data, timeout=10)
-            success = response.status_code == 200
-            if not success:
-                print(f"❌ Ошибка Telegram API: {response.text}")
-            return success
+            })
+            return True
     except Exception as e:
-        print(f"❌ Ошибка отправки: {e}")
+        log.error("Ошибка отправки: %s", e, extra={"chat_id": chat_id})
         return False
 
-# ВЕБ-ХУК С РУЧНОЙ ОБРАБОТКОЙ
-@app.route('/webhook', methods=['POST'])
-def webhook():
+# ПОТОКОВЫЙ ВЫВОД ОТВЕТА В TELEGRAM
+class TelegramStreamWriter:
+    """Публикует ответ по мере генерации: первое сообщение сразу, дальше - редкие правки"""
+
+    # Лимит Telegram на длину одного сообщения
+    MESSAGE_LIMIT = 4096
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.interval = Config.STREAM_GROUP_EDIT_INTERVAL if chat_id < 0 else Config.STREAM_EDIT_INTERVAL
+        self.text = ''
+        self.message_id = None
+        self.shown = ''
+        self.last_publish = 0.0
+        self._pending_edit = None
+        self.messages = 0
+        self.edits = 0
+
+    def feed(self, delta):
+        self.text += delta
+        while len(self.text) > self.MESSAGE_LIMIT:
+            # Завершаем текущее сообщение на границе строки или слова и начинаем новое
+            cut = self.text.rfind('\n', self.MESSAGE_LIMIT // 2, self.MESSAGE_LIMIT)
+            if cut == -1:
+                cut = self.text.rfind(' ', self.MESSAGE_LIMIT // 2, self.MESSAGE_LIMIT)
+            if cut == -1:
+                cut = self.MESSAGE_LIMIT
+            head, self.text = self.text[:cut], self.text[cut:].lstrip()
+            self._publish(head)
+            self.message_id = None
+            self.shown = ''
+        # Первое сообщение отправляем без задержки - это и есть время до первого токена
+        if self.message_id is None or time.monotonic() - self.last_publish >= self.interval:
+            # Пока предыдущая правка в очереди отправки, новую не добавляем
+            if self._pending_edit is None or self._pending_edit.done():
+                self._publish(self.text)
+
+    def close(self):
+        self._wait_pending()
+        self._publish(self.text)
+        self._wait_pending()
+
+    def _wait_pending(self):
+        if self._pending_edit is not None:
+            self._pending_edit.result(timeout=60)
+            self._pending_edit = None
+
+    def _publish(self, text):
+        text = text.rstrip()
+        if not text or text == self.shown:
+            return
+        # Без parse_mode: частичный текст почти всегда содержит незакрытую разметку
+        if self.message_id is None:
+            # message_id нужен для следующих правок, поэтому ждем ответа
+            self._wait_pending()
+            result = telegram_sender.submit(self.chat_id, "sendMessage",
+                                            {"chat_id": self.chat_id, "text": text}).result(timeout=60)
+            if result:
+                self.message_id = result.get("message_id")
+                self.messages += 1
+        else:
+            self._pending_edit = telegram_sender.submit(self.chat_id, "editMessageText", {
+                "chat_id": self.chat_id,
+                "message_id": self.message_id,
+                "text": text
+            })
+            self.edits += 1
+        self.shown = text
+        self.last_publish = time.monotonic()
+
+def stream_telegram_reply(chat_id, chunks, cancelled=None):
+    """Транслирует фрагменты ответа GigaChat в чат; при отмене прекращает генерацию"""
+    writer = TelegramStreamWriter(chat_id)
+    for delta in chunks:
+        if cancelled is not None and cancelled.is_set():
+            # Закрытие генератора освобождает слот GigaChat и соединение
+            chunks.close()
+            break
+        writer.feed(delta)
+    writer.close()
+    return writer
+
+# ОТВЕТ НА ВОПРОС ПОЛЬЗОВАТЕЛЯ
+def answer_question(chat_id, user_id, user_name, text, cancelled=None):
+    """Запрашивает ответ GigaChat и отправляет его; cancelled - событие отмены (вопрос дополнен)"""
+    # Частый вопрос отвечаем из локальной базы, не обращаясь к GigaChat. Уточнение к идущему
+    # диалогу ("а какие там проходные баллы?") решает модель: ей нужна история
+    follow_up = faq_index.is_follow_up(text) and conversation_memory.has_history(chat_id)
+    faq_answer = None if follow_up else faq_index.lookup(text)
+    if faq_answer is not None:
+        send_telegram_message(chat_id, faq_answer)
+        conversation_memory.add(chat_id, text, faq_answer)
+        log.info("Ответ из базы частых вопросов", extra={"chat_id": chat_id, "user_id": user_id, "sampled": True})
+        return
+    
+    # Показываем, что бот печатает
     try:
-        if request.content_type != 'application/json':
-            return "Invalid content-type", 400
-            
-        json_data = request.get_json()
-        if not json_data:
-            return "Empty JSON", 400
-        
-        print(f"📥 Получен webhook")
-        
-        if 'message' in json_data:
-            message = json_data['message']
-            chat_id = message['chat']['id']
-            text = message.get('text', '')
-            user_name = message.get('from', {}).get('first_name', 'Пользователь')
-            
-            print(f"💬 Сообщение от {user_name}: {text}")
-            
-            if text == '/start':
-                welcome_text = f"""
+        url = telegram_url("sendChatAction")
+        data = {"chat_id": chat_id, "action": "typing"}
+        telegram_http.post(url, json=data, timeout=5)
+    except:
+        pass
+    
+    log.debug("Запрос к GigaChat от %s: %s", user_name, text, extra={"chat_id": chat_id})
+    started = time.perf_counter()
+    if Config.STREAMING:
+        stream_telegram_reply(chat_id, get_gigachat().stream_response(text, user_id, chat_id), cancelled)
+    else:
+        giga_response = get_gigachat().get_response(text, user_id, chat_id)
+        if cancelled is not None and cancelled.is_set():
+            # Текст вопроса войдет в новый, более полный вопрос - в истории он не нужен
+            conversation_memory.discard_last(chat_id, text)
+            log.info("Ответ заменен более полным вопросом", extra={"chat_id": chat_id})
+            return
+        send_telegram_message(chat_id, giga_response)
+    log.info("Ответ GigaChat отправлен", extra={"chat_id": chat_id, "user_id": user_id, "sampled": True,
+                                               "latency_ms": round((time.perf_counter() - started) * 1000)})
+
+# СКЛЕЙКА БЫСТРЫХ СООБЩЕНИЙ ОДНОГО ЧАТА
+class _PendingQuestion:
+    __slots__ = ('user_id', 'user_name', 'texts', 'deadline', 'cancelled')
+
+    def __init__(self, user_id, user_name):
+        self.user_id = user_id
+        self.user_name = user_name
+        self.texts = []
+        self.deadline = 0.0
+        self.cancelled = threading.Event()
+
+class ChatCoalescer:
+    """Сообщения чата, пришедшие с паузой меньше окна, уходят в GigaChat одним вопросом
+
+    Если вопрос чата уже обрабатывается и приходит продолжение, старый запрос
+    отменяется (его ответ не отправляется), а его текст входит в новый вопрос.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._in_flight = {}
+        self._deadlines = []
+        self._sequence = 0
+        self._pid = None
+        self.messages = 0
+        self.batches = 0
+        self.superseded = 0
+
+    def add(self, chat_id, user_id, user_name, text):
+        self._ensure_started()
+        with self._cond:
+            self.messages += 1
+            question = self._pending.get(chat_id)
+            if question is None:
+                question = self._pending[chat_id] = _PendingQuestion(user_id, user_name)
+                previous = self._in_flight.get(chat_id)
+                if previous is not None and not previous.cancelled.is_set():
+                    previous.cancelled.set()
+                    question.texts.extend(previous.texts)
+                    self.superseded += 1
+            question.texts.append(text)
+            question.deadline = time.monotonic() + self.window
+            self._sequence += 1
+            heapq.heappush(self._deadlines, (question.deadline, self._sequence, chat_id))
+            self._cond.notify()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name="chat-coalescer", daemon=True).start()
+        register_shutdown_drain()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                chat_id, question = self._next_due()
+                self._in_flight[chat_id] = question
+                self.batches += 1
+            # Постановка в пул может ждать (QUEUE_FULL_POLICY=wait) - уже без блокировки
+            if not dispatcher.submit(self._answer, chat_id, question):
+                with self._cond:
+                    if self._in_flight.get(chat_id) is question:
+                        del self._in_flight[chat_id]
+                send_telegram_message(chat_id, BUSY_MESSAGE)
+
+    def _next_due(self):
+        """Ждет (под блокировкой) чат, у которого истекло окно, и снимает его вопрос"""
+        while True:
+            if not self._deadlines:
+                self._cond.wait()
+                continue
+            deadline, _, chat_id = self._deadlines[0]
+            question = self._pending.get(chat_id)
+            if question is None or question.deadline != deadline:
+                # Окно продлено следующим сообщением - запись устарела
+                heapq.heappop(self._deadlines)
+                continue
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._cond.wait(delay)
+                continue
+            heapq.heappop(self._deadlines)
+            del self._pending[chat_id]
+            return chat_id, question
+
+    def flush(self):
+        """Закрывает окна всех чатов сразу: перед остановкой вопросы не ждут продолжения"""
+        with self._cond:
+            now = time.monotonic()
+            for chat_id, question in self._pending.items():
+                question.deadline = now
+                self._sequence += 1
+                heapq.heappush(self._deadlines, (now, self._sequence, chat_id))
+            self._cond.notify()
+
+    def pending(self):
+        """Вопросы, ждущие окончания окна или постановки в пул"""
+        with self._cond:
+            return len(self._pending) + len(self._in_flight)
+
+    def _answer(self, chat_id, question):
+        try:
+            answer_question(chat_id, question.user_id, question.user_name,
+                            '\n'.join(question.texts), question.cancelled)
+        finally:
+            with self._cond:
+                if self._in_flight.get(chat_id) is question:
+                    del self._in_flight[chat_id]
+
+    def stats(self):
+        with self._cond:
+            return {
+                "window_ms": round(self.window * 1000),
+                "messages": self.messages,
+                "batches": self.batches,
+                "superseded": self.superseded,
+                "pending_chats": len(self._pending)
+            }
+
+chat_coalescer = ChatCoalescer(Config.COALESCE_WINDOW_MS / 1000.0)
+
+# КОМАНДЫ БОТА
+class ReplyTemplate:
+    """Тело sendMessage, сериализованное в JSON один раз при запуске
+
+    В тексте допускается подстановка {user_name}; при отправке к готовым байтам
+    добавляются только chat_id и экранированное (HTML и JSON) имя пользователя.
+    """
+    __slots__ = ('_segments', '_text')
+
+    NAME_LIMIT = 64
+
+    def __init__(self, text):
+        pieces = text.split('{user_name}')
+        if len(text) + (len(pieces) - 1) * self.NAME_LIMIT > 4000:
+            raise ValueError("шаблон ответа длиннее одного сообщения Telegram")
+        encoded = [json.dumps(piece, ensure_ascii=False)[1:-1].encode('utf-8') for piece in pieces]
+        encoded[0] = b',"parse_mode":"HTML","text":"' + encoded[0]
+        encoded[-1] += b'"}'
+        self._segments = encoded
+        self._text = text
+
+    def render(self, chat_id, user_name=None):
+        segments = self._segments
+        if len(segments) == 1:
+            return b'{"chat_id":' + str(chat_id).encode() + segments[0]
+        name = json.dumps(html.escape((user_name or 'Пользователь')[:self.NAME_LIMIT]),
+                          ensure_ascii=False)[1:-1].encode('utf-8')
+        return b'{"chat_id":' + str(chat_id).encode() + name.join(segments)
+
+class CommandRegistry:
+    """Команды бота: обработчик ищется по имени в словаре, без цепочки сравнений
+
+    Понимает /cmd, /cmd@имя_бота и аргументы после пробела. Команда, адресованная
+    другому боту (@другое_имя в группе), игнорируется; пока собственное имя неизвестно,
+    чужой считается любая команда с @. Новая команда добавляется декоратором
+    @bot_commands.command('имя').
+    """
+
+    # Пауза перед новой попыткой узнать имя бота, если getMe не ответил
+    USERNAME_RETRY = 30.0
+
+    def __init__(self):
+        self._handlers = {}
+        self._username = None
+        self._username_retry_at = 0.0
+        self._username_lock = threading.Lock()
+
+    def command(self, *names):
+        def register(handler):
+            for name in names:
+                self._handlers[name.lower()] = handler
+            return handler
+        return register
+
+    @staticmethod
+    def parse(text):
+        """'/cmd@bot арг' -> ('cmd', 'bot', 'арг'); имя команды должно идти сразу после '/'"""
+        if not text[1:2] or text[1:2].isspace():
+            return '', '', ''
+        parts = text[1:].split(None, 1)
+        name, _, target = (parts[0] if parts else '').partition('@')
+        return name.lower(), target, parts[1].strip() if len(parts) > 1 else ''
+
+    def dispatch(self, text, chat_id, user_id, user_name):
+        """Выполняет команду; False - такой команды нет или она адресована другому боту"""
+        name, target, args = self.parse(text)
+        handler = self._handlers.get(name)
+        if handler is None:
+            return False
+        if target:
+            username = self.bot_username()
+            if not username or target.lower() != username.lower():
+                return False
+        handler(chat_id, user_id, user_name, args)
+        return True
+
+    def bot_username(self):
+        """Имя бота: BOT_USERNAME, результат проверки getMe или один собственный запрос getMe"""
+        username = Config.BOT_USERNAME or health_prober.bot_username or self._username
+        if username or time.monotonic() < self._username_retry_at:
+            return username
+        with self._username_lock:
+            if self._username or time.monotonic() < self._username_retry_at:
+                return self._username
+            try:
+                data = telegram_http.post(telegram_url("getMe"), timeout=5).json()
+                self._username = (data.get("result") or {}).get("username") if data.get("ok") else None
+            except Exception as e:
+                log.warning("Не удалось узнать имя бота: %s", e)
+            if not self._username:
+                self._username_retry_at = time.monotonic() + self.USERNAME_RETRY
+            return self._username
+
+    def names(self):
+        return sorted(self._handlers)
+
+bot_commands = CommandRegistry()
+
+START_REPLY = ReplyTemplate("""
 🌍 ДОБРО ПОЖАЛОВАТЬ В БОТ ПО МЕЖДУНАРОДНЫМ ОТНОШЕНИЯМ, {user_name}!
 
 🎯 Я специализируюсь на международных отношениях и использую нейросеть GigaChat для ответов на ваши вопросы.
@@ -357,12 +3179,9 @@ def webhook():
 "Какие языки важно знать международнику?"
 
 🚀 Начните с любого вопроса!
-"""
-                send_telegram_message(chat_id, welcome_text)
-                print(f"✅ Приветствие отправлено для {user_name}")
-            
-            elif text == '/help':
-                help_text = """
+""")
+
+HELP_REPLY = ReplyTemplate("""
 ❓ ПОМОЩЬ ПО БОТУ МЕЖДУНАРОДНЫХ ОТНОШЕНИЙ
 
 🎯 Я использую нейросеть GigaChat для ответов на вопросы по:
@@ -385,89 +3204,416 @@ def webhook():
 ⚡ Просто напишите ваш вопрос - и получите развернутый ответ от GigaChat!
 
 🔄 Если возникли проблемы - используйте /status для проверки системы.
-"""
-                send_telegram_message(chat_id, help_text)
-            
-            elif text == '/status':
-                status_text = f"""
+""")
+
+@bot_commands.command('start')
+def command_start(chat_id, user_id, user_name, args):
+    # Новый диалог: прежние реплики не должны влиять на ответы
+    conversation_memory.clear(chat_id)
+    telegram_sender.submit(chat_id, "sendMessage", START_REPLY.render(chat_id, user_name))
+    log.info("Приветствие отправлено", extra={"chat_id": chat_id, "sampled": True})
+
+@bot_commands.command('help')
+def command_help(chat_id, user_id, user_name, args):
+    telegram_sender.submit(chat_id, "sendMessage", HELP_REPLY.render(chat_id))
+
+@bot_commands.command('status')
+def command_status(chat_id, user_id, user_name, args):
+    # Результаты фоновой проверки - без запросов к GigaChat по команде пользователя
+    health = health_prober.results()
+    status_text = f"""
 📊 СТАТУС СИСТЕМЫ:
 
 🤖 Бот: ✅ Активен
-🧠 GigaChat: {'✅ Настроен' if gigachat.is_configured else '❌ Не настроен'}
+🧠 GigaChat: {'✅ Настроен' if get_gigachat().is_configured else '❌ Не настроен'}
 📜 Сертификаты: {'✅' if Path(CERT_PATH).exists() or CERT_URL else '❌'}
-🌐 Веб-хук: ✅ Работает
-💬 Пользователь: {user_name}
-
-💡 Тестируем подключение к GigaChat...
+🔐 Авторизация GigaChat: {health_prober.mark(health['oauth'])}
+🔧 API GigaChat: {health_prober.mark(health['gigachat'])}
+🌐 Telegram API: {health_prober.mark(health['telegram'])}
+💬 Пользователь: {html.escape(user_name)}
 """
-                send_telegram_message(chat_id, status_text)
-                
-                # Тестовый запрос
-                test_response = gigachat.get_response("Ответь кратко: работает ли соединение?")
-                status_text = f"🔧 Тест GigaChat: {'✅ Успешно' if 'Ошибка' not in test_response else '❌ Ошибка'}"
-                if 'Ошибка' not in test_response:
-                    status_text += f"\n\n📝 Пример ответа: {test_response[:100]}..."
-                send_telegram_message(chat_id, status_text)
-            
-            elif text and not text.startswith('/'):
-                # Показываем, что бот печатает
+    send_telegram_message(chat_id, status_text)
+
+# ОБРАБОТКА ОБНОВЛЕНИЯ (выполняется в фоновом пуле)
+def process_update(json_data):
+    """Обрабатывает одно обновление Telegram: команды и вопросы к GigaChat"""
+    if 'message' in json_data:
+        message = json_data['message']
+        chat_id = message['chat']['id']
+        text = message.get('text', '')
+        user_name = message.get('from', {}).get('first_name', 'Пользователь')
+        user_id = message.get('from', {}).get('id', chat_id)
+        
+        update_id = json_data.get('update_id')
+        
+        log.info("Сообщение от %s", user_name, extra={"chat_id": chat_id, "user_id": user_id, "update_id": update_id,
+                                                  "chars": len(text), "sampled": True})
+        log.debug("Текст сообщения: %s", text, extra={"chat_id": chat_id, "update_id": update_id})
+        
+        if text.startswith('/'):
+            if not bot_commands.dispatch(text, chat_id, user_id, user_name):
+                log.debug("Игнорируем сообщение: %s", text, extra={"chat_id": chat_id})
+        
+        elif text:
+            if Config.COALESCE_WINDOW_MS > 0:
+                chat_coalescer.add(chat_id, user_id, user_name, text)
+            else:
+                answer_question(chat_id, user_id, user_name, text)
+        
+        else:
+            log.debug("Игнорируем сообщение: %s", text, extra={"chat_id": chat_id})
+
+# ЗАЩИТА ОТ ПОВТОРНОЙ ДОСТАВКИ ОБНОВЛЕНИЙ
+class UpdateDeduplicator:
+    """Окно уже обработанных update_id: повторная доставка того же обновления отбрасывается
+
+    В памяти id хранятся в отсортированном array('q') (8 байт на запись) с параллельным
+    массивом времени получения; между воркерами gunicorn окно делится через SQLite.
+    """
+
+    def __init__(self, capacity, window, db_path=None):
+        self.capacity = max(1, capacity)
+        self.window = window
+        self.db_path = db_path or None
+        self._store_checked = False
+        self._ids = array('q')
+        self._seen_at = array('d')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._inserts = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.store_errors = 0
+
+    def first_seen(self, update_id):
+        """Отмечает update_id и возвращает True, если он встретился впервые"""
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            pos = bisect.bisect_left(self._ids, update_id)
+            if pos < len(self._ids) and self._ids[pos] == update_id:
+                self.duplicates += 1
+                return False
+            # Место под новый id освобождается только при вставке: иначе при полном окне
+            # проверяемый id, если он самый старый, вытеснялся бы до поиска
+            if len(self._ids) >= self.capacity:
+                self._evict(now, room=1)
+                pos = bisect.bisect_left(self._ids, update_id)
+            # update_id растут, поэтому вставка почти всегда в конец массива
+            self._ids.insert(pos, update_id)
+            self._seen_at.insert(pos, now)
+        if not self._store_first_seen(update_id, now):
+            with self._lock:
+                self.duplicates += 1
+            return False
+        with self._lock:
+            self.accepted += 1
+        return True
+
+    def forget(self, update_id):
+        """Снимает отметку: обновление не принято в обработку и Telegram пришлет его снова"""
+        with self._lock:
+            pos = bisect.bisect_left(self._ids, update_id)
+            if pos < len(self._ids) and self._ids[pos] == update_id:
+                del self._ids[pos]
+                del self._seen_at[pos]
+        if self._store_usable():
+            try:
+                conn = self._db()
+                with conn:
+                    conn.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+            except sqlite3.Error as e:
+                self.store_errors += 1
+                log.warning("Ошибка хранилища update_id: %s", e)
+
+    def _evict(self, now, room=0):
+        """Удаляет самые старые id пачкой: вышедшие из окна и, при room, освобождая место под новые"""
+        excess = len(self._ids) - self.capacity + room
+        cutoff = now - self.window
+        count = max(0, excess)
+        while count < len(self._ids) and self._seen_at[count] < cutoff:
+            count += 1
+        if count:
+            del self._ids[:count]
+            del self._seen_at[:count]
+
+    def _store_usable(self):
+        """Файл SQLite живет в каталоге 0700 владельца процесса
+
+        Чужой каталог мог бы заранее получить "увиденные" будущие update_id и молча
+        глушить настоящие обновления: тогда общее хранилище отключается с предупреждением.
+        """
+        if not self._store_checked:
+            if self.db_path:
                 try:
-                    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendChatAction"
-                    data = {"chat_id": chat_id, "action": "typing"}
-                    requests.post(url, json=data, timeout=5)
-                except:
-                    pass
-                
-                print(f"🧠 Запрос к GigaChat от {user_name}: {text}")
-                giga_response = gigachat.get_response(text)
-                send_telegram_message(chat_id, giga_response)
-                print(f"✅ Ответ GigaChat отправлен для {user_name}")
-            
+                    ensure_private_dir(os.path.dirname(os.path.abspath(self.db_path)))
+                except OSError as e:
+                    log.warning("Общее хранилище update_id отключено: %s", e)
+                    self.db_path = None
+            self._store_checked = True
+        return bool(self.db_path)
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS seen_updates "
+                     "(update_id INTEGER PRIMARY KEY, seen_at REAL NOT NULL)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _store_first_seen(self, update_id, now):
+        """Атомарная отметка в общем хранилище; при его ошибке полагаемся на память процесса"""
+        if not self._store_usable():
+            return True
+        try:
+            conn = self._db()
+            with conn:
+                inserted = conn.execute("INSERT OR IGNORE INTO seen_updates (update_id, seen_at) VALUES (?, ?)",
+                                        (update_id, now)).rowcount == 1
+                self._inserts += 1
+                if self._inserts % 500 == 0:
+                    conn.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - self.window,))
+            return inserted
+        except sqlite3.Error as e:
+            self.store_errors += 1
+            log.warning("Ошибка хранилища update_id: %s", e)
+            return True
+
+    def stats(self):
+        return {
+            "window": self.window,
+            "capacity": self.capacity,
+            "tracked": len(self._ids),
+            "shared_store": self.db_path,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "store_errors": self.store_errors
+        }
+
+update_deduplicator = UpdateDeduplicator(Config.DEDUP_CAPACITY, Config.DEDUP_WINDOW, Config.DEDUP_DB)
+
+# ФОНОВЫЙ ПУЛ ОБРАБОТКИ ОБНОВЛЕНИЙ
+class UpdateDispatcher:
+    """Ограниченная очередь и пул потоков: веб-хук только ставит задачу и сразу отвечает"""
+
+    def __init__(self, workers, queue_size, put_timeout):
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.put_timeout = put_timeout
+        self._queue = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._active_lock = threading.Lock()
+        self.active = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        """Запускает потоки лениво: после fork воркера gunicorn потоков родителя нет"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"update-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+            log.info("Пул обработки запущен: %s потоков, очередь %s", self.workers, self.queue_size)
+        register_shutdown_drain()
+
+    def submit(self, func, *args):
+        """Ставит задачу в очередь; возвращает False, если очередь переполнена"""
+        self._ensure_started()
+        try:
+            if Config.QUEUE_FULL_POLICY == 'wait':
+                self._queue.put((func, args), timeout=self.put_timeout)
             else:
-                print(f"⚠️  Игнорируем сообщение: {text}")
+                self._queue.put_nowait((func, args))
+        except queue.Full:
+            self.rejected += 1
+            log.warning("Очередь обработки переполнена (%s)", self.queue_size)
+            return False
+        self.accepted += 1
+        return True
+
+    def _worker_loop(self):
+        while True:
+            func, args = self._queue.get()
+            with self._active_lock:
+                self.active += 1
+            try:
+                func(*args)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                log.exception("Ошибка фоновой обработки: %s", e)
+            finally:
+                with self._active_lock:
+                    self.active -= 1
+                self._queue.task_done()
+
+    def pending(self):
+        """Принятые и еще не завершенные задачи (в очереди и в работе)"""
+        return self._queue.unfinished_tasks if self._queue is not None else 0
+
+    def stats(self):
+        return {
+            "mode": Config.DISPATCH_MODE,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "full_policy": Config.QUEUE_FULL_POLICY,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed
+        }
+
+dispatcher = UpdateDispatcher(Config.WORKER_THREADS, Config.QUEUE_SIZE, Config.QUEUE_PUT_TIMEOUT)
+
+_drain_registered_pid = None
+
+def register_shutdown_drain():
+    """Регистрирует дообработку при выходе процесса (один раз на процесс, после fork - заново)
+
+    Поток записи логов запускается раньше: atexit вызывает обработчики в обратном
+    порядке, и логи дообработки успевают записаться до его остановки.
+    """
+    global _drain_registered_pid
+    if _drain_registered_pid == os.getpid():
+        return
+    _drain_registered_pid = os.getpid()
+    log_handler.ensure_listener()
+    atexit.register(_drain_at_exit, os.getpid())
+
+def _drain_at_exit(pid):
+    """Обновления, на которые Telegram получил 200, он уже не повторит - дообрабатываем их"""
+    if pid != os.getpid() or Config.SHUTDOWN_DRAIN_TIMEOUT <= 0:
+        return
+    if chat_coalescer.pending() or dispatcher.pending() or telegram_sender.pending():
+        log.info("Воркер завершается, дообработка до %s с", Config.SHUTDOWN_DRAIN_TIMEOUT)
+        drain_pending(Config.SHUTDOWN_DRAIN_TIMEOUT)
+
+def drain_pending(timeout=None):
+    """Ждет, пока склейка, пул обработки и отправка в Telegram закончат принятую работу
+
+    Возвращает False, если за timeout секунд (None - без ограничения) работа не закончилась.
+    """
+    chat_coalescer.flush()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    reported = time.monotonic()
+    while True:
+        pending = {
+            "coalescer": chat_coalescer.pending(),
+            "dispatcher": dispatcher.pending(),
+            "telegram": telegram_sender.pending()
+        }
+        if not any(pending.values()):
+            return True
+        if deadline is not None and time.monotonic() >= deadline:
+            log.warning("Остановка без дообработки: осталось %s", pending)
+            return False
+        if time.monotonic() - reported >= 10:
+            reported = time.monotonic()
+            log.info("Дообработка перед остановкой: %s", pending)
+        time.sleep(0.1)
+
+# ВЕБ-ХУК: ПРОВЕРКА И ПОСТАНОВКА В ОЧЕРЕДЬ
+@bp.route('/webhook', methods=['POST'])
+def webhook():
+    metrics.ensure_flusher()
+    health_prober.ensure_started()
+    started = time.perf_counter()
+    body, status, result = _accept_update()
+    elapsed = time.perf_counter() - started
+    WEBHOOK_DURATION.observe(elapsed, result)
+    log.info("Webhook обработан", extra={"status": status, "result": result, "sampled": True,
+                                         "latency_ms": round(elapsed * 1000, 2)})
+    return body, status
+
+def _accept_update():
+    """Проверяет обновление и ставит его в очередь; возвращает тело, код и исход для метрик"""
+    try:
+        if request.content_type != 'application/json':
+            return "Invalid content-type", 400, "invalid"
+            
+        json_data = request.get_json()
+        if not json_data:
+            return "Empty JSON", 400, "invalid"
+        
+        update_id = json_data.get('update_id')
+        if update_id is not None and not update_deduplicator.first_seen(update_id):
+            log.info("Повторная доставка обновления - пропускаем", extra={"update_id": update_id})
+            return "OK", 200, "duplicate"
+        
+        if Config.DISPATCH_MODE == 'inline':
+            try:
+                process_update(json_data)
+            except Exception:
+                if update_id is not None:
+                    update_deduplicator.forget(update_id)
+                raise
+        elif not dispatcher.submit(process_update, json_data):
+            if Config.QUEUE_FULL_POLICY == 'drop':
+                log.warning("Обновление отброшено: очередь переполнена", extra={"update_id": update_id})
+                return "Dropped", 200, "dropped"
+            # Обновление не принято - повторная доставка не должна считаться дублем
+            if update_id is not None:
+                update_deduplicator.forget(update_id)
+            # Telegram повторит доставку позже - так работает обратное давление
+            return "Busy", 503, "busy"
         
-        return "OK", 200
+        return "OK", 200, "accepted"
         
     except Exception as e:
-        print(f"❌ Ошибка webhook: {e}")
-        import traceback
-        traceback.print_exc()
-        return "Error", 500
+        log.exception("Ошибка webhook: %s", e)
+        return "Error", 500, "error"
 
 # Тест GigaChat
-@app.route('/test_gigachat')
+@bp.route('/test_gigachat')
 def test_gigachat():
-    """Тест подключения к GigaChat"""
-    test_message = "Привет! Ответь кратко: что такое международные отношения?"
-    try:
-        response = gigachat.get_response(test_message)
-        return jsonify({
-            "status": "success",
-            "gigachat_configured": gigachat.is_configured,
-            "certificate_configured": Path(CERT_PATH).exists() or bool(CERT_URL),
-            "test_message": test_message,
-            "response": response,
-            "response_length": len(response) if response else 0
-        })
-    except Exception as e:
-        return jsonify({
-            "status": "error",
-            "error": str(e)
-        })
+    """Тест подключения к GigaChat: последний результат фоновой проверки, без генерации"""
+    health_prober.ensure_started()
+    health = health_prober.results()
+    ok = health['oauth']['ok'] and health['gigachat']['ok']
+    return jsonify({
+        "status": {True: "success", False: "error"}.get(ok, "pending"),
+        "gigachat_configured": get_gigachat().is_configured,
+        "certificate_configured": Path(CERT_PATH).exists() or bool(CERT_URL),
+        "oauth": health['oauth'],
+        "gigachat": health['gigachat'],
+        "circuit": gigachat_breaker.stats()["state"]
+    })
 
 # Главная страница
-@app.route('/')
+@bp.route('/')
 def home():
+    health_prober.ensure_started()
+    health = health_prober.results()
     return """
     <h1>🌍 Бот по международным отношениям с GigaChat</h1>
     <p><strong>Status:</strong> ✅ Active</p>
     <p><strong>SSL Certificates:</strong> {}</p>
     <p><strong>GigaChat:</strong> {}</p>
+    <p><strong>Проверка сервисов:</strong> OAuth {} · GigaChat API {} · Telegram API {}</p>
     
     <h3>Тесты:</h3>
     <ul>
         <li><a href="/test_gigachat">Тест GigaChat</a></li>
         <li><a href="/status">Статус системы</a></li>
+        <li><a href="/metrics">Метрики</a></li>
     </ul>
     
     <h3>Функции:</h3>
@@ -482,33 +3628,304 @@ def home():
     <p>Отправьте /start боту в Telegram!</p>
     """.format(
         '✅ Configured' if Path(CERT_PATH).exists() or CERT_URL else '❌ Not configured',
-        '✅ Configured' if gigachat.is_configured else '❌ Not configured'
+        '✅ Configured' if get_gigachat().is_configured else '❌ Not configured',
+        *(health_prober.mark(result) for result in health.values())
     )
 
-@app.route('/status')
+@bp.route('/status')
 def status():
+    health_prober.ensure_started()
     return jsonify({
         "bot_status": "active",
-        "gigachat_configured": gigachat.is_configured,
+        "gigachat_configured": get_gigachat().is_configured,
         "certificate_configured": Path(CERT_PATH).exists() or bool(CERT_URL),
-        "webhook_set": True
+        "webhook_set": True,
+        "health": health_prober.results(),
+        "startup_ms": STARTUP_STATS.get("startup_ms"),
+        "dispatcher": dispatcher.stats(),
+        "http_pools": http_pool_stats(),
+        "token": token_manager.stats(),
+        "response_cache": response_cache.stats(),
+        "telegram_sender": telegram_sender.stats(),
+        "dedup": update_deduplicator.stats(),
+        "gigachat_admission": gigachat_admission.stats(),
+        "gigachat_breaker": dict(gigachat_breaker.stats(), timeouts={
+            kind: round(adaptive.current(), 2) for kind, adaptive in gigachat_timeouts.items()
+        }),
+        "coalescer": chat_coalescer.stats(),
+        "conversation_memory": conversation_memory.stats(),
+        "faq": faq_index.stats(),
+        "logging": log_handler.stats()
     })
 
-if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 10000))
-    print(f"🌐 Сервер запущен на порту {port}")
-    print(f"🔐 GigaChat: {'✅ Настроен' if gigachat.is_configured else '❌ Не настроен'}")
-    print(f"📜 Сертификаты: {'✅ Настроены' if Path(CERT_PATH).exists() or CERT_URL else '❌ Не настроены'}")
+# Метрики, которые читаются из состояния компонентов при сборе
+CallbackMetric(metrics, "gauge", "bot_updates_queued", "Обновления в очереди пула обработки",
+               lambda: dispatcher.stats()["queued"])
+CallbackMetric(metrics, "gauge", "bot_updates_in_progress", "Обновления в обработке",
+               lambda: dispatcher.active)
+CallbackMetric(metrics, "gauge", "bot_gigachat_in_flight", "Выполняющиеся запросы к GigaChat",
+               lambda: gigachat_admission.stats()["in_flight"])
+CallbackMetric(metrics, "gauge", "bot_gigachat_queued", "Запросы, ожидающие слота GigaChat",
+               lambda: gigachat_admission.stats()["queued"])
+CallbackMetric(metrics, "gauge", "bot_telegram_send_queued", "Сообщения в очереди отправки Telegram",
+               lambda: telegram_sender.stats()["queued"])
+CallbackMetric(metrics, "gauge", "bot_gigachat_circuit_state", "Состояние автомата отключения GigaChat",
+               lambda: {state: int(state == gigachat_breaker.stats()["state"])
+                        for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)},
+               ("state",), merge="max")
+CallbackMetric(metrics, "counter", "bot_gigachat_circuit_rejected_total", "Запросы, отклоненные автоматом GigaChat",
+               lambda: gigachat_breaker.rejected)
+CallbackMetric(metrics, "counter", "bot_gigachat_rejected_total", "Отказы в слоте GigaChat (занято)",
+               lambda: gigachat_admission.rejected + gigachat_admission.timeouts)
+CallbackMetric(metrics, "counter", "bot_response_cache_requests_total", "Обращения к кэшу ответов",
+               lambda: {"hit": response_cache.hits, "disk_hit": response_cache.disk_hits,
+                        "miss": response_cache.misses}, ("result",))
+CallbackMetric(metrics, "counter", "bot_faq_lookups_total", "Поиск по базе частых вопросов",
+               lambda: {"hit": faq_index.hits, "miss": faq_index.lookups - faq_index.hits}, ("result",))
+CallbackMetric(metrics, "gauge", "bot_upstream_up", "Результат последней проверки сервиса (1 - доступен)",
+               lambda: {name: int(bool(result["ok"])) for name, result in health_prober.results().items()}, ("check",),
+               merge="max")
+CallbackMetric(metrics, "counter", "bot_telegram_messages_total", "Итог отправки сообщений Telegram",
+               lambda: {"sent": telegram_sender.sent, "failed": telegram_sender.failed,
+                        "retried": telegram_sender.retries}, ("result",))
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    metrics.ensure_flusher()
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# ОДНОРАЗОВАЯ НАСТРОЙКА: СЕРТИФИКАТ И ВЕБ-ХУК
+def setup_webhook():
+    """Загружает сертификат и устанавливает веб-хук; запускается один раз при деплое"""
+    import telebot
+
+    try:
+        download_certificate()
+    except Exception as e:
+        log.error("Ошибка загрузки сертификата: %s", e)
     
-    # Тестовый запрос
-    if gigachat.is_configured:
-        print("🧪 Тестируем GigaChat...")
-        try:
-            test_response = gigachat.get_response("Тестовое сообщение")
-            print(f"✅ GigaChat тест: {'Успешно' if 'Ошибка' not in test_response else 'Ошибка'}")
-            if 'Ошибка' not in test_response:
-                print(f"📄 Ответ: {test_response[:100]}...")
+    telebot.apihelper.API_URL = Config.TELEGRAM_API_URL + "/bot{0}/{1}"
+    bot = telebot.TeleBot(BOT_TOKEN)
+    try:
+        bot.remove_webhook()
+        time.sleep(1)
+        bot.set_webhook(url=f"{APP_URL}/webhook")
+        log.info("Веб-хук установлен: %s/webhook", APP_URL)
+        return True
+    except Exception as e:
+        log.error("Ошибка веб-хука: %s", e)
+        return False
+
+# РЕЖИМ LONG POLLING: getUpdates ВМЕСТО ВЕБ-ХУКА
+class TelegramRetryAfter(Exception):
+    """Telegram ответил 429: повторить запрос через retry_after секунд"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"retry_after {retry_after}")
+        self.retry_after = retry_after
+
+class UpdatePoller:
+    """Забирает обновления пачками через getUpdates и отдает их в тот же пул обработки
+
+    Смещение хранится в файле и заменяется атомарно. Несколько процессов-потребителей
+    опрашивают Telegram по очереди под flock на файле смещения: каждый забирает пачку,
+    сохраняет новое смещение и обрабатывает пачку в своем пуле, пока следующий опрашивает.
+    """
+
+    def __init__(self, offset_path, limit, timeout, allowed_updates):
+        self.offset_path = offset_path
+        self.limit = min(100, max(1, limit))
+        self.timeout = max(0, timeout)
+        self.allowed_updates = allowed_updates
+        self._stop = threading.Event()
+        self._offset = None
+        self.polls = 0
+        self.received = 0
+        self.duplicates = 0
+        self.errors = 0
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def run(self):
+        """Цикл опроса до stop(); перед стартом снимает веб-хук - иначе getUpdates вернет 409"""
+        metrics.ensure_flusher()
+        health_prober.ensure_started()
+        self._check_offset_dir()
+        self._delete_webhook()
+        log.info("Long polling запущен: limit %s, timeout %s с, смещение в %s",
+                 self.limit, self.timeout, self.offset_path or "памяти")
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                batch = self._poll_batch()
+                backoff = 1.0
+            except TelegramRetryAfter as e:
+                log.warning("getUpdates: Telegram 429, повтор через %s с", e.retry_after)
+                self._stop.wait(e.retry_after)
+                continue
+            except Exception as e:
+                self.errors += 1
+                log.error("Ошибка getUpdates: %s; повтор через %s с", e, backoff)
+                self._stop.wait(backoff)
+                backoff = min(30.0, backoff * 2)
+                continue
+            # Смещение пачки уже сохранено: Telegram ее не повторит, поэтому пачка
+            # обрабатывается целиком и после stop()
+            for update in batch:
+                self._submit(update)
+        log.info("Long polling остановлен: %s", self.stats())
+
+    def _poll_batch(self):
+        """Один getUpdates под межпроцессной блокировкой; смещение сохраняется до обработки"""
+        with _FileLock(f"{self.offset_path}.lock" if self.offset_path else None):
+            if self._stop.is_set():
+                return []
+            offset = self._read_offset()
+            payload = {"timeout": self.timeout, "limit": self.limit}
+            if offset is not None:
+                payload["offset"] = offset
+            if self.allowed_updates:
+                payload["allowed_updates"] = self.allowed_updates
+            started = time.perf_counter()
+            response = telegram_http.post(telegram_url("getUpdates"), json=payload, timeout=self.timeout + 10)
+            data = response.json()
+            if response.status_code == 429:
+                raise TelegramRetryAfter(data.get("parameters", {}).get("retry_after", 5))
+            if not data.get("ok"):
+                raise RuntimeError(f"{response.status_code} {data.get('description')}")
+            batch = data.get("result") or []
+            self.polls += 1
+            if batch:
+                # Telegram подтверждает пачку при следующем запросе со смещением больше ее update_id;
+                # повтор после сбоя отсеет хранилище update_id
+                self._write_offset(batch[-1]["update_id"] + 1)
+                self.received += len(batch)
+                log.info("Получена пачка из %s обновлений", len(batch),
+                         extra={"sampled": True, "latency_ms": round((time.perf_counter() - started) * 1000)})
+            return batch
+
+    def _submit(self, update):
+        """Отдает обновление в пул; при переполненной очереди ждет, а после stop() обрабатывает само"""
+        update_id = update.get("update_id")
+        if update_id is not None and not update_deduplicator.first_seen(update_id):
+            self.duplicates += 1
+            return
+        if Config.DISPATCH_MODE == 'inline':
+            self._process_inline(update)
+            return
+        while not dispatcher.submit(process_update, update):
+            if self._stop.wait(0.5):
+                self._process_inline(update)
+                return
+
+    @staticmethod
+    def _process_inline(update):
+        try:
+            process_update(update)
         except Exception as e:
-            print(f"❌ GigaChat тест: {e}")
+            log.exception("Ошибка обработки обновления: %s", e, extra={"update_id": update.get("update_id")})
+
+    def _delete_webhook(self):
+        try:
+            response = telegram_http.post(telegram_url("deleteWebhook"), json={"drop_pending_updates": False},
+                                          timeout=10)
+            if not response.json().get("ok"):
+                log.warning("deleteWebhook: %s", response.text)
+        except Exception as e:
+            log.warning("Не удалось снять веб-хук: %s", e)
+
+    def _check_offset_dir(self):
+        """Файл смещения - в каталоге 0700: подложенное смещение подтвердило бы и потеряло обновления"""
+        if not self.offset_path:
+            return
+        try:
+            ensure_private_dir(os.path.dirname(os.path.abspath(self.offset_path)))
+        except OSError as e:
+            log.warning("Файл смещения отключен, смещение только в памяти: %s", e)
+            self.offset_path = None
+
+    def _read_offset(self):
+        if not self.offset_path:
+            return self._offset
+        try:
+            return int(read_private_json(self.offset_path)["offset"])
+        except (KeyError, TypeError, ValueError):
+            return self._offset
+
+    def _write_offset(self, offset):
+        """Атомарная запись: временный файл, fsync и rename поверх старого"""
+        self._offset = offset
+        if not self.offset_path:
+            return
+        try:
+            write_private_json(self.offset_path, {"offset": offset, "updated_at": time.time()}, durable=True)
+        except OSError as e:
+            log.warning("Не удалось сохранить смещение в %s: %s", self.offset_path, e)
+
+    def drain(self):
+        """Ждет ответов на все принятые обновления, включая части в очереди Telegram: их уже не вернут"""
+        drain_pending()
+
+    def stats(self):
+        return {
+            "offset": self._offset,
+            "limit": self.limit,
+            "timeout": self.timeout,
+            "polls": self.polls,
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "errors": self.errors
+        }
+
+def run_polling():
+    """python app.py poll: опрос до SIGTERM/SIGINT, затем дообработка текущей пачки и всей очереди"""
+    poller = UpdatePoller(Config.POLL_OFFSET_PATH, Config.POLL_LIMIT, Config.POLL_TIMEOUT,
+                          Config.POLL_ALLOWED_UPDATES)
+    signal.signal(signal.SIGTERM, poller.stop)
+    signal.signal(signal.SIGINT, poller.stop)
+    poller.run()
+    poller.drain()
+    return poller
+
+# ФАБРИКА ПРИЛОЖЕНИЯ
+STARTUP_STATS = {}
+
+def create_app():
+    """Создает Flask-приложение без сетевых вызовов: клиенты и потоки запускаются лениво"""
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(bp)
+    
+    STARTUP_STATS["startup_ms"] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+    log.info("Бот запускается: токен %s, GigaChat Auth %s, CERT_PATH %s, CERT_URL %s",
+             "задан" if BOT_TOKEN else "не задан", "задан" if GIGACHAT_AUTH else "не задан",
+             CERT_PATH, "задан" if CERT_URL else "не задан")
+    log.info("Воркер готов (pid %s)", os.getpid(), extra={"latency_ms": STARTUP_STATS["startup_ms"]})
+    return flask_app
+
+# Приложение для gunicorn (app:app); веб-хук ставится отдельно: python app.py setup
+app = create_app()
+
+# Запуск: python app.py setup - только сертификат и веб-хук, python app.py serve - только сервер,
+# python app.py poll - long polling без веб-хука и HTTP-сервера,
+# python app.py - настройка и сервер в одном процессе (как раньше)
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    if command == 'setup':
+        sys.exit(0 if setup_webhook() else 1)
+    if command == 'poll':
+        run_polling()
+        sys.exit(0)
+    if command == 'run':
+        setup_webhook()
+    # SIGTERM завершает процесс штатно: atexit дообработает принятые обновления
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    
+    port = int(os.environ.get('PORT', 10000))
+    log.info("Сервер запущен на порту %s; GigaChat %s; сертификаты %s", port,
+             "настроен" if get_gigachat().is_configured else "не настроен",
+             "настроены" if Path(CERT_PATH).exists() or CERT_URL else "не настроены")
+    # Доступность GigaChat и Telegram проверяется в фоне, без тестового запроса к модели
+    health_prober.ensure_started()
     
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,73 @@
+"""Микробенчмарк разбиения длинных сообщений: split_message против старого цикла со срезами
+
+Запуск: python bench_chunker.py [размеры...]  (по умолчанию 10k, 100k, 1M символов)
+"""
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+from app import split_message
+
+LIMIT = 4000
+
+PLAIN_WORDS = [
+    "дипломатия", "международное", "право", "МГИМО", "ООН.", "ВТО,", "геополитика!",
+    "безопасность?", "\n", "\n\n"
+]
+HTML_WORDS = PLAIN_WORDS + [
+    "<b>важно</b>", "<i>курсив <b>и жирный</b></i>", '<a href="https://mgimo.ru">сайт</a>',
+    "&amp;", "&lt;tag&gt;"
+]
+
+def legacy_split(text, max_length=LIMIT):
+    """Прежний алгоритм из send_telegram_message: срез хвоста на каждой итерации"""
+    parts = []
+    while text:
+        if len(text) <= max_length:
+            parts.append(text)
+            break
+        split_pos = text.rfind('\n', 0, max_length)
+        if split_pos == -1:
+            split_pos = text.rfind('. ', 0, max_length)
+        if split_pos == -1:
+            split_pos = text.rfind(' ', 0, max_length)
+        if split_pos == -1:
+            split_pos = max_length
+        parts.append(text[:split_pos])
+        text = text[split_pos:].lstrip()
+    return parts
+
+def make_text(size, vocabulary, seed=42):
+    rnd = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rnd.choice(vocabulary)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+def best_of(func, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parts = func(text)
+        best = min(best, time.perf_counter() - started)
+    return best, len(parts)
+
+def main(sizes):
+    print(f"{'text':>6} {'size':>10} {'parts':>6} {'split_message, ms':>18} {'legacy, ms':>12} {'speedup':>8}")
+    for kind, vocabulary in (("plain", PLAIN_WORDS), ("html", HTML_WORDS)):
+        for size in sizes:
+            text = make_text(size, vocabulary)
+            repeat = 20 if size <= 100_000 else 5
+            new_time, new_parts = best_of(split_message, text, repeat)
+            old_time, _ = best_of(legacy_split, text, repeat)
+            print(f"{kind:>6} {size:>10} {new_parts:>6} {new_time * 1000:>18.2f} {old_time * 1000:>12.2f} "
+                  f"{old_time / new_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
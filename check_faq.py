@@ -0,0 +1,82 @@
+"""Проверка базы частых вопросов: свои формулировки находят свой ответ, посторонние - ничего, уточнения распознаются
+
+Запуск: python check_faq.py [путь к faq.json]  (код выхода 1, если есть ошибки)
+"""
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:check")
+
+from app import Config, FaqIndex
+
+# Похожие на вопросы базы, но требующие другого ответа: их должен получить GigaChat
+NEGATIVE = [
+    "Какие экзамены нужны для поступления в МГИМО на журналистику?",
+    "Какие главные органы ООН и как их реформировать?",
+    "Какие проходные баллы в МГИМО на юриспруденцию?",
+    "Какие экзамены нужны для поступления в медицинский?",
+    "Кто постоянные члены НАТО?",
+    "Какие олимпиады по математике проводит МФТИ?",
+    "Какая структура Евросоюза?",
+    "Чем занимается дипломат в Китае в 19 веке?",
+    "МГИМО",
+    "ООН",
+    "Привет",
+    "Что такое право вето в Евросоюзе?",
+]
+
+# Уточнения к идущему диалогу: при истории чата их решает GigaChat, а не база
+FOLLOW_UP = [
+    "а какие там проходные баллы?",
+    "А в МГУ?",
+    "Какие экзамены нужны туда?",
+    "И сколько языков там учат?",
+    "Кто его возглавляет?",
+]
+
+# Перефразированные вопросы, на которые база должна ответить: (вопрос, id записи)
+POSITIVE = [
+    ("Подскажите, какие экзамены нужны для поступления в МГИМО?", "mgimo_exams"),
+    ("Какие главные органы ООН", "un_structure"),
+    ("что такое дипломатия", "diplomacy"),
+    ("Кто постоянные члены Совбеза ООН", "un_security_council"),
+]
+
+def main(path):
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    index = FaqIndex(path, Config.FAQ_MIN_SCORE, Config.FAQ_MIN_COVERAGE, reload_interval=3600)
+    if not index.load():
+        return 1
+    answer_ids = {entry["answer"]: entry["id"] for entry in entries}
+    errors = []
+    checked = 0
+    started = time.perf_counter()
+    own = [(question, entry["id"]) for entry in entries for question in entry["questions"]]
+    for question, expected in own + POSITIVE:
+        checked += 1
+        found = answer_ids.get(index.lookup(question))
+        if found != expected:
+            errors.append(f"ожидался {expected}, получен {found}: {question}")
+    for question in NEGATIVE:
+        checked += 1
+        found = answer_ids.get(index.lookup(question))
+        if found is not None:
+            errors.append(f"ложное совпадение с {found}: {question}")
+    for question in FOLLOW_UP:
+        checked += 1
+        if not FaqIndex.is_follow_up(question):
+            errors.append(f"уточнение не распознано: {question}")
+    for question, _ in own + POSITIVE:
+        if FaqIndex.is_follow_up(question):
+            errors.append(f"самостоятельный вопрос принят за уточнение: {question}")
+    elapsed = time.perf_counter() - started
+    for error in errors:
+        print(error)
+    print(f"Проверено {checked} вопросов ({len(NEGATIVE)} посторонних) за {elapsed * 1000:.1f} мс, ошибок: {len(errors)}")
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else Config.FAQ_PATH))
@@ -0,0 +1,493 @@
+"""Нагрузочный тест бота на локальных заглушках OAuth, GigaChat и Bot API
+
+Поднимает заглушки вышестоящих сервисов, запускает бота (python app.py serve или
+--server-cmd) с адресами сервисов, указывающими на заглушки, и с заданной частотой
+отправляет синтетические обновления в /webhook. Печатает пропускную способность,
+перцентили задержек webhook и до первого ответа в чат, число обращений к сервисам.
+
+В режиме --mode poll бот запускается как python app.py poll, а обновления
+отдает заглушка getUpdates (--backlog - накопленные до старта обновления).
+
+Запуск: python loadtest.py --rate 50 --duration 30 [--latency 0.8] [--stream]
+        [--error-rate 0.05] [--gigachat-429 0.05] [--telegram-429 0.01] [--json]
+"""
+import argparse
+import collections
+from collections import deque
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+BOT_TOKEN = "123456:loadtest"
+CHAT_BASE = 10_000_000
+QUESTIONS = [
+    "Какие экзамены нужно сдавать в МГИМО?", "Сколько стоит обучение?", "Есть ли общежитие?",
+    "Какие языки изучают на факультете МО?", "Когда начинается прием документов?",
+    "Какой проходной балл на бюджет?", "Есть ли магистратура на английском?"
+]
+
+# ЗАГЛУШКИ ВЫШЕСТОЯЩИХ СЕРВИСОВ
+class FakeUpstream:
+    """Общее состояние заглушек: параметры задержек и ошибок, счетчики вызовов, время ответов"""
+
+    def __init__(self, args):
+        self.latency = args.latency
+        self.jitter = args.jitter
+        self.error_rate = args.error_rate
+        self.gigachat_429 = args.gigachat_429
+        self.telegram_429 = args.telegram_429
+        self.answer_chars = args.answer_chars
+        self.stream_chunks = args.stream_chunks
+        self.calls = collections.Counter()
+        self.injected = collections.Counter()
+        self._sent_at = {}
+        self.first_reply = []
+        self._message_id = 0
+        self._random = random.Random(args.seed)
+        self._lock = threading.Lock()
+        self._updates = deque()
+        self._updates_ready = threading.Condition(self._lock)
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def inject(self, name, probability):
+        """Решает, внедрять ли ошибку name с вероятностью probability"""
+        with self._lock:
+            if probability > 0 and self._random.random() < probability:
+                self.injected[name] += 1
+                return True
+        return False
+
+    def delay(self):
+        with self._lock:
+            spread = self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+        return max(0.0, self.latency * (1 + spread))
+
+    def mark_sent(self, chat_id, sent_at):
+        with self._lock:
+            self._sent_at[chat_id] = sent_at
+
+    def mark_reply(self, chat_id):
+        """Первое сообщение в чат после обновления - время до первого ответа"""
+        now = time.perf_counter()
+        with self._lock:
+            sent_at = self._sent_at.pop(chat_id, None)
+            if sent_at is not None:
+                self.first_reply.append(now - sent_at)
+
+    def push_update(self, update):
+        with self._lock:
+            self._updates.append(update)
+            self._updates_ready.notify_all()
+
+    def get_updates(self, offset, limit, timeout):
+        """getUpdates: offset подтверждает полученные ранее, ожидание до timeout секунд"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._updates and offset and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_ready.wait(deadline - time.monotonic())
+            return [update for _, update in zip(range(limit), self._updates)]
+
+    def next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def pending_replies(self):
+        with self._lock:
+            return len(self._sent_at)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.injected.clear()
+            self._sent_at.clear()
+            self.first_reply.clear()
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """Один обработчик на все заглушки: маршрут определяется путем запроса"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def upstream(self):
+        return self.server.upstream
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.endswith("/models"):
+            self.upstream.count("gigachat models")
+            self._send_json(200, {"object": "list", "data": [{"id": "GigaChat", "object": "model"}]})
+        else:
+            self._send_json(404, {"message": "not found"})
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.endswith("/oauth"):
+            self._oauth()
+        elif self.path.endswith("/chat/completions"):
+            self._completions(json.loads(body or b"{}"))
+        elif self.path.startswith("/bot"):
+            self._bot_api(self.path.rsplit("/", 1)[-1], json.loads(body or b"{}"))
+        else:
+            self._send_json(404, {"message": "not found"})
+
+    def _oauth(self):
+        self.upstream.count("oauth")
+        self._send_json(200, {"access_token": "loadtest-token",
+                              "expires_at": int((time.time() + 1800) * 1000)})
+
+    def _answer(self, question):
+        answer = f"Ответ на вопрос «{question}». "
+        filler = "Подробности о поступлении можно найти на сайте университета. "
+        while len(answer) < self.upstream.answer_chars:
+            answer += filler
+        return answer[:max(self.upstream.answer_chars, 1)]
+
+    def _completions(self, data):
+        upstream = self.upstream
+        stream = bool(data.get("stream"))
+        upstream.count("gigachat stream" if stream else "gigachat completions")
+        if upstream.inject("gigachat 429", upstream.gigachat_429):
+            self._send_json(429, {"status": 429, "message": "Too Many Requests"}, {"Retry-After": "1"})
+            return
+        delay = upstream.delay()
+        if upstream.inject("gigachat 500", upstream.error_rate):
+            time.sleep(delay / 2)
+            self._send_json(500, {"status": 500, "message": "Internal Server Error"})
+            return
+        question = data.get("messages", [{}])[-1].get("content", "")
+        answer = self._answer(question)
+        if not stream:
+            time.sleep(delay)
+            self._send_json(200, {"choices": [{"message": {"role": "assistant", "content": answer},
+                                               "index": 0, "finish_reason": "stop"}],
+                                  "model": data.get("model", "GigaChat"), "object": "chat.completion"})
+            return
+        self._stream(answer, delay)
+
+    def _stream(self, answer, delay):
+        """SSE с chunked-кодированием: первый фрагмент через половину задержки, остальные равномерно"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunks = max(1, self.upstream.stream_chunks)
+        step = -(-len(answer) // chunks)
+        pieces = [answer[i:i + step] for i in range(0, len(answer), step)]
+        time.sleep(delay / 2)
+        for index, piece in enumerate(pieces):
+            if index:
+                time.sleep(delay / 2 / len(pieces))
+            event = {"choices": [{"delta": {"content": piece}, "index": 0}]}
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _bot_api(self, method, data):
+        upstream = self.upstream
+        upstream.count(f"telegram {method}")
+        if method in ("sendMessage", "editMessageText") and upstream.inject("telegram 429", upstream.telegram_429):
+            self._send_json(429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                  "parameters": {"retry_after": 1}})
+            return
+        if method == "sendMessage":
+            upstream.mark_reply(data.get("chat_id"))
+        if method in ("sendMessage", "editMessageText"):
+            result = {"message_id": data.get("message_id") or upstream.next_message_id(),
+                      "chat": {"id": data.get("chat_id")}, "text": data.get("text", "")}
+        elif method == "getUpdates":
+            result = upstream.get_updates(data.get("offset"), data.get("limit", 100), min(data.get("timeout", 0), 5))
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Load", "username": "loadtest_bot"}
+        else:
+            result = True
+        self._send_json(200, {"ok": True, "result": result})
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение (бот остановлен или прервал поток) - это не ошибка заглушки
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def start_fake_server(upstream, port=0):
+    server = FakeServer(("127.0.0.1", port), FakeHandler)
+    server.upstream = upstream
+    threading.Thread(target=server.serve_forever, name="fake-upstream", daemon=True).start()
+    return server
+
+# БОТ ПОД НАГРУЗКОЙ
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_bot(args, upstream_url, workdir):
+    """Запускает бота с адресами сервисов на заглушках; возвращает процесс и URL бота"""
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "BOT_TOKEN": BOT_TOKEN,
+        "GIGACHAT_AUTH": "bG9hZHRlc3Q6bG9hZHRlc3Q=",
+        "TELEGRAM_API_URL": upstream_url,
+        "GIGACHAT_API_URL": f"{upstream_url}/api/v1",
+        "GIGACHAT_OAUTH_URL": f"{upstream_url}/api/v2/oauth",
+        "CERT_URL": "",
+        "TOKEN_STORE_PATH": os.path.join(workdir, "token.json"),
+        "DEDUP_DB": os.path.join(workdir, "updates.db"),
+        "METRICS_DIR": os.path.join(workdir, "metrics"),
+        "GIGACHAT_SLOTS_DIR": os.path.join(workdir, "slots"),
+        "RESPONSE_CACHE_DB": "",
+        "POLL_OFFSET_PATH": os.path.join(workdir, "offset.json"),
+        "POLL_TIMEOUT": "2",
+        "STREAMING": "1" if args.stream else "0",
+        "LOG_LEVEL": args.log_level
+    })
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    if args.server_cmd:
+        command = shlex.split(args.server_cmd.format(port=port, python=sys.executable))
+    else:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"),
+                   "poll" if args.mode == "poll" else "serve"]
+    output = None if args.show_server_log else subprocess.DEVNULL
+    process = subprocess.Popen(command, env=env, stdout=output, stderr=output)
+    return process, f"http://127.0.0.1:{port}"
+
+def wait_ready(url, process, upstream, mode, timeout=30):
+    """Webhook - бот отвечает на GET /, poll - бот уже запрашивает getUpdates"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Бот завершился с кодом {process.returncode}")
+        if mode == "poll":
+            if upstream.calls["telegram getUpdates"]:
+                return
+        else:
+            try:
+                if requests.get(f"{url}/", timeout=1).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Бот не ответил за {timeout} с")
+
+# ГЕНЕРАТОР НАГРУЗКИ
+def make_update(index, args):
+    chat_id = CHAT_BASE + index
+    if args.distinct:
+        question = QUESTIONS[index % len(QUESTIONS)] if args.distinct <= len(QUESTIONS) else \
+            f"{QUESTIONS[index % len(QUESTIONS)]} (вариант {index % args.distinct})"
+    else:
+        question = f"{QUESTIONS[index % len(QUESTIONS)]} #{index}"
+    return chat_id, {
+        "update_id": 500_000_000 + index,
+        "message": {
+            "message_id": index + 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"Нагрузка{index}"},
+            "text": question
+        }
+    }
+
+def replay(webhook_url, args, upstream):
+    """Отправляет обновления по расписанию (открытая модель нагрузки)
+
+    Задержка считается от запланированного момента отправки, а не от фактического:
+    если бот не успевает и отправители простаивают в ожидании, это входит в результат.
+    """
+    total = int(args.rate * args.duration)
+    local = threading.local()
+    started = time.perf_counter() + 0.2
+
+    def send(index):
+        scheduled = started + index / args.rate
+        pause = scheduled - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        # Номера после накопленных: getUpdates отдает обновления по возрастанию update_id
+        chat_id, update = make_update(args.backlog + index, args)
+        upstream.mark_sent(chat_id, scheduled)
+        if args.mode == "poll":
+            upstream.push_update(update)
+            return "queued", time.perf_counter() - scheduled
+        try:
+            status = session.post(webhook_url, json=update, timeout=args.timeout).status_code
+        except requests.exceptions.RequestException:
+            status = "error"
+        return status, time.perf_counter() - scheduled
+
+    with ThreadPoolExecutor(max_workers=args.senders, thread_name_prefix="sender") as pool:
+        results = list(pool.map(send, range(total)))
+    return results, time.perf_counter() - started
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def latency_summary(values):
+    values = sorted(values)
+    summary = {"count": len(values)}
+    for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+        value = percentile(values, fraction)
+        summary[f"{name}_ms"] = round(value * 1000, 1) if value is not None else None
+    summary["max_ms"] = round(values[-1] * 1000, 1) if values else None
+    return summary
+
+def run(args):
+    upstream = FakeUpstream(args)
+    server = start_fake_server(upstream, args.upstream_port)
+    upstream_url = f"http://127.0.0.1:{server.server_address[1]}"
+    process = None
+    with tempfile.TemporaryDirectory(prefix="bot-loadtest-") as workdir:
+        try:
+            if args.target:
+                print(f"Заглушки сервисов: {upstream_url}", file=sys.stderr)
+                bot_url = args.target.rstrip("/")
+            else:
+                process, bot_url = start_bot(args, upstream_url, workdir)
+            wait_ready(bot_url, process, upstream, args.mode)
+            upstream.reset()
+            if args.mode == "poll":
+                # Накопленные за время простоя обновления: бот разбирает их пачками
+                for index in range(args.backlog):
+                    chat_id, update = make_update(index, args)
+                    upstream.mark_sent(chat_id, time.perf_counter())
+                    upstream.push_update(update)
+
+            results, send_time = replay(f"{bot_url}/webhook", args, upstream)
+            drain_started = time.perf_counter()
+            while upstream.pending_replies() and time.perf_counter() - drain_started < args.drain:
+                time.sleep(0.1)
+            elapsed = time.perf_counter() - drain_started + send_time
+        finally:
+            if process is not None:
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            server.shutdown()
+
+    statuses = collections.Counter(str(status) for status, _ in results)
+    return {
+        "config": {"mode": args.mode, "rate": args.rate, "duration": args.duration, "stream": args.stream,
+                   "latency": args.latency, "error_rate": args.error_rate,
+                   "gigachat_429": args.gigachat_429, "telegram_429": args.telegram_429,
+                   "server": args.target or args.server_cmd or f"app.py {'poll' if args.mode == 'poll' else 'serve'}"},
+        "sent": len(results),
+        "webhook_status": dict(statuses),
+        "webhook_rps": round(len(results) / send_time, 1) if send_time else None,
+        "replies": len(upstream.first_reply),
+        "reply_rps": round(len(upstream.first_reply) / elapsed, 1) if elapsed else None,
+        "unanswered": upstream.pending_replies(),
+        "webhook_latency": latency_summary([latency for _, latency in results]),
+        "first_reply_latency": latency_summary(upstream.first_reply),
+        "upstream_calls": dict(sorted(upstream.calls.items())),
+        "injected_errors": dict(sorted(upstream.injected.items()))
+    }
+
+def print_report(report):
+    config = report["config"]
+    print(f"Нагрузка ({config['mode']}): {config['rate']} обн/с x {config['duration']} с, streaming={config['stream']}, "
+          f"задержка GigaChat {config['latency']} с, сервер: {config['server']}")
+    print(f"Отправлено: {report['sent']} ({report['webhook_rps']} обн/с), статусы webhook: {report['webhook_status']}")
+    print(f"Ответов в чат: {report['replies']} ({report['reply_rps']} /с), без ответа: {report['unanswered']}")
+    print(f"{'задержка, мс':<16} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for title, key in (("webhook", "webhook_latency"), ("первый ответ", "first_reply_latency")):
+        row = report[key]
+        if key == "webhook_latency" and config["mode"] == "poll":
+            continue
+        cells = " ".join(f"{'-' if row[name] is None else row[name]:>9}" for name in ("p50_ms", "p95_ms", "p99_ms", "max_ms"))
+        print(f"{title:<16} {row['count']:>7} {cells}")
+    print("Обращения к сервисам:")
+    for name, count in report["upstream_calls"].items():
+        print(f"  {name:<28} {count:>7}")
+    if report["injected_errors"]:
+        print(f"Внедренные ошибки: {report['injected_errors']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных заглушках")
+    parser.add_argument("--mode", choices=("webhook", "poll"), default="webhook",
+                        help="прием обновлений: POST /webhook или getUpdates (app.py poll)")
+    parser.add_argument("--backlog", type=int, default=0,
+                        help="обновлений, накопленных до старта (только --mode poll)")
+    parser.add_argument("--rate", type=float, default=20, help="обновлений в секунду")
+    parser.add_argument("--duration", type=float, default=10, help="длительность отправки, с")
+    parser.add_argument("--senders", type=int, default=64, help="потоков-отправителей webhook")
+    parser.add_argument("--timeout", type=float, default=10, help="таймаут запроса к webhook, с")
+    parser.add_argument("--drain", type=float, default=30, help="сколько ждать оставшиеся ответы, с")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="число различных вопросов (0 - все уникальны, кэш ответов не работает)")
+    parser.add_argument("--latency", type=float, default=0.5, help="задержка ответа GigaChat, с")
+    parser.add_argument("--jitter", type=float, default=0.2, help="разброс задержки, доля от --latency")
+    parser.add_argument("--stream", action="store_true", help="потоковые ответы (STREAMING=1)")
+    parser.add_argument("--stream-chunks", type=int, default=20, help="фрагментов в потоковом ответе")
+    parser.add_argument("--answer-chars", type=int, default=600, help="длина ответа GigaChat")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов GigaChat 500")
+    parser.add_argument("--gigachat-429", type=float, default=0.0, help="доля ответов GigaChat 429")
+    parser.add_argument("--telegram-429", type=float, default=0.0, help="доля ответов Bot API 429")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--target", help="URL уже запущенного бота вместо запуска app.py")
+    parser.add_argument("--upstream-port", type=int, default=0,
+                        help="порт заглушек (для --target бот должен смотреть на него)")
+    parser.add_argument("--server-cmd",
+                        help="команда запуска бота, например \"gunicorn -w 4 -b 127.0.0.1:{port} app:app\"")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="дополнительные переменные окружения бота")
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL бота")
+    parser.add_argument("--show-server-log", action="store_true", help="не скрывать вывод бота")
+    parser.add_argument("--json", action="store_true", help="вывести отчет в JSON")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)